@@ -1,24 +1,32 @@
-from fastapi import Depends, HTTPException, status
+import os
+
+from fastapi import Depends, HTTPException, Request, Response, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from sqlalchemy import select
+from itsdangerous import BadSignature, TimestampSigner
 from sqlalchemy.orm import Session
 from typing import Annotated
 
-from .db.models import APICredentials
+from .db.models import GET_API_CREDENTIALS_BY_KEY
 from .db.engine import get_local_session
 
 b = HTTPBasic()
 
+# requests may carry a session cookie instead, so missing basic auth isn't fatal
+optional_b = HTTPBasic(auto_error=False)
 
-def authenticate_user(
-    credentials: Annotated[HTTPBasicCredentials, Depends(b)],
-    session: Annotated[Session, Depends(get_local_session)],
-):
-    stmt = select(APICredentials).where(
-        APICredentials.api_key == credentials.username.encode("utf8")
-    )
+SESSION_COOKIE_NAME = "session"
+SESSION_MAX_AGE = 3600
+
+
+def get_session_signer() -> TimestampSigner:
+    return TimestampSigner(os.environ["SECRET_KEY"], salt="session")
 
-    result = session.execute(stmt)
+
+def verify_credentials(credentials: HTTPBasicCredentials, session: Session):
+    result = session.execute(
+        GET_API_CREDENTIALS_BY_KEY,
+        {"api_key": credentials.username.encode("utf8")},
+    )
 
     valid_users = result.all()
 
@@ -41,3 +49,58 @@ def authenticate_user(
         )
 
     return valid_user
+
+
+def authenticate_user(
+    request: Request,
+    credentials: Annotated[HTTPBasicCredentials | None, Depends(optional_b)],
+    session: Annotated[Session, Depends(get_local_session)],
+) -> str:
+    """Returns the API key of the caller, taken from a valid session cookie
+    when present so the database lookup and password hash are skipped."""
+    session_cookie = request.cookies.get(SESSION_COOKIE_NAME)
+
+    if session_cookie:
+        try:
+            return (
+                get_session_signer()
+                .unsign(session_cookie, max_age=SESSION_MAX_AGE)
+                .decode("utf8")
+            )
+        except BadSignature:
+            pass
+
+    if credentials is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+
+    verify_credentials(credentials, session)
+
+    return credentials.username
+
+
+def login(
+    response: Response,
+    credentials: Annotated[HTTPBasicCredentials, Depends(b)],
+    session: Annotated[Session, Depends(get_local_session)],
+):
+    """Exchange API credentials for a signed session cookie that is valid for an hour.
+    Note that revoking an API key does not invalidate cookies that were already issued.
+    """
+    verify_credentials(credentials, session)
+
+    response.set_cookie(
+        SESSION_COOKIE_NAME,
+        get_session_signer().sign(credentials.username).decode("utf8"),
+        max_age=SESSION_MAX_AGE,
+        httponly=True,
+        # the API is only served over HTTPS; the flag is for the plain HTTP test client
+        secure=os.getenv("SESSION_COOKIE_SECURE", "true").lower() == "true",
+        # the cookie authorizes state changing requests, so never send it cross-site
+        samesite="strict",
+    )
+
+    return {"status": "OK"}
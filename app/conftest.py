@@ -1,10 +1,34 @@
+import asyncio
+import boto3
 import dotenv
+import httpx
 import os
 import pytest
 
+from botocore.config import Config
+from moto import mock_aws
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 
+dotenv.load_dotenv()
+
+# the test client talks plain HTTP, where a secure cookie would never be sent back
+os.environ.setdefault("SESSION_COOKIE_SECURE", "false")
+
+# under pytest-xdist every worker creates and drops its own database; S3 needs no
+# such treatment since each worker process runs its own moto backend
+if "PYTEST_XDIST_WORKER" in os.environ:
+    os.environ["DB_NAME"] = f"{os.environ['DB_NAME']}_{os.environ['PYTEST_XDIST_WORKER']}"
+
+
+# the payload for tests that upload a file and don't care about its contents; the
+# dataset deduplicates uploads by sha1, so tests there append a counter to it
+TEST_PAYLOAD = b"\0" * 64
+
+# stay well under the database pool size; when every threadpool worker is waiting
+# on a connection, none is left to run the session cleanup that would free one
+UPLOAD_CONCURRENCY = 8
+
 
 def create_database():
     from .db.commands.generate_ddl import generate_ddl
@@ -61,3 +85,79 @@ def my_fixture():
     create_database()
     yield  # this is where the testing happens
     drop_database()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def s3_client():
+    """Mock S3 once for the whole run and create the buckets up front, instead of
+    starting moto and creating a bucket in every test. The client is shared too, since
+    building a boto3 client costs tens of milliseconds."""
+    with mock_aws():
+        s3_client = boto3.client(
+            "s3",
+            region_name="us-east-1",
+            # moto never fails transiently, so a retry would only hide a real error
+            config=Config(
+                max_pool_connections=50,
+                retries={"max_attempts": 1, "mode": "standard"},
+            ),
+        )
+        s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
+        s3_client.create_bucket(Bucket=os.environ["MLMODEL_S3_BUCKET"])
+
+        yield s3_client
+
+
+@pytest.fixture(scope="session")
+def auth(my_fixture):
+    """One API key shared by every test, so each test doesn't insert and hash its own."""
+    from .db.commands.create_api_key import create_api_key
+
+    return create_api_key("test")
+
+
+@pytest.fixture(scope="session")
+def client(my_fixture):
+    """One TestClient for the whole run, entered as a context manager so the app's
+    startup and shutdown run once rather than per test module."""
+    from fastapi.testclient import TestClient
+
+    from .main import app
+
+    with TestClient(app) as client:
+        yield client
+
+
+async def _upload_many(uploads, auth):
+    from .main import app
+
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://testserver"
+    ) as async_client:
+
+        async def upload(file_name, file_contents, tags):
+            async with semaphore:
+                return await async_client.post(
+                    "/dataset",
+                    files={"file": (file_name, file_contents)},
+                    data={"tags": tags},
+                    auth=auth,
+                )
+
+        return await asyncio.gather(
+            *[upload(*file_upload) for file_upload in uploads]
+        )
+
+
+@pytest.fixture(scope="session")
+def upload_many(auth):
+    """Uploads (file name, file contents, tags) triples to the dataset concurrently and
+    returns the responses, so tests that need a lot of files don't wait on each upload
+    in turn."""
+
+    def upload(uploads):
+        return asyncio.run(_upload_many(uploads, auth))
+
+    return upload
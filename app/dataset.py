@@ -1,7 +1,6 @@
-import boto3
 import hashlib
-import json
 import logging
+import orjson
 import os
 
 from fastapi import (
@@ -12,42 +11,51 @@ from fastapi import (
     status,
 )
 from fastapi.exceptions import HTTPException
-from fastapi.responses import StreamingResponse
-from fastapi.security import HTTPBasicCredentials
-from mimetypes import guess_type
-from sqlalchemy import insert, select, func
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, RedirectResponse
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import exists, insert, literal, select, func
+from sqlalchemy.orm import Session, selectinload
 from typing import Annotated
 from uuid import uuid4, UUID
 
-from .auth import authenticate_user
 from .db.engine import get_local_session
 from .db.models import (
+    GET_DATASET_OBJECT_BY_ID,
+    GET_DATASET_OBJECT_BY_SHA1,
+    GET_DATASET_OBJECT_DETAILS_BY_ID,
     DatasetObject,
     DatasetObjectLabel,
     DatasetObjectTag,
 )
+from .storage import get_s3_client, guess_content_type, upload_file
 from .types import (
     BasicResponse,
     UploadFileResponse,
     DatasetFileDetails,
     ListFilesResponse,
+    NewLabel,
+    Point,
 )
 
 
 logger = logging.getLogger(__name__)
 
+# downloads are redirected to S3, so the presigned URL only needs to outlive the redirect
+DOWNLOAD_URL_EXPIRES_IN = 300
+
+POLYGON_ADAPTER = TypeAdapter(list[Point])
+LABELS_ADAPTER = TypeAdapter(list[NewLabel])
+
 
 def dataset_upload_file(
     file: Annotated[UploadFile, File(...)],
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     tags: Annotated[list[str], Form(...)] = None,
 ) -> UploadFileResponse:
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
 
     file_name = file.filename
-    content_type, encoding = guess_type(file.filename)
+    content_type = guess_content_type(file.filename, file.content_type)
 
     # calculate the file's sha1 hash
     sha1 = hashlib.sha1()
@@ -62,10 +70,9 @@ def dataset_upload_file(
     file.file.seek(0)
 
     # see if a file with this hash already exists
-    file_query = select(DatasetObject).where(
-        DatasetObject.file_hash_sha1 == sha1.hexdigest()
-    )
-    file_result = session.execute(file_query).all()
+    file_result = session.execute(
+        GET_DATASET_OBJECT_BY_SHA1, {"sha1": sha1.hexdigest()}
+    ).all()
 
     if len(file_result) > 0 and len(file_result[0]) > 0:
         raise HTTPException(
@@ -75,10 +82,12 @@ def dataset_upload_file(
 
     s3_object_name = f"{uuid4()}-{file_name}"
 
-    s3.upload_fileobj(
+    upload_file(
+        s3,
         file.file,
         os.environ["DATASET_S3_BUCKET"],
         s3_object_name,
+        content_type=content_type,
     )
 
     dso_result = session.execute(
@@ -94,14 +103,10 @@ def dataset_upload_file(
     dso_id = dso_result.inserted_primary_key[0]
 
     if tags:
-        for tag in tags:
-            session.execute(
-                insert(DatasetObjectTag).values(
-                    id=uuid4(),
-                    dataset_object_id=dso_id,
-                    tag=tag,
-                )
-            )
+        session.execute(
+            insert(DatasetObjectTag),
+            [{"id": uuid4(), "dataset_object_id": dso_id, "tag": tag} for tag in tags],
+        )
 
     session.commit()
 
@@ -114,11 +119,11 @@ def dataset_upload_file(
 
 def dataset_download_file(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
 ):
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
+    file_result = session.execute(
+        GET_DATASET_OBJECT_BY_ID, {"guid": file_guid}
+    ).one_or_none()
 
     if not file_result:
         raise HTTPException(
@@ -128,23 +133,27 @@ def dataset_download_file(
 
     file = file_result[0]  # DatasetObject is in the first element of the tuple
 
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
 
-    s3_object = s3.get_object(
-        Bucket=os.environ["DATASET_S3_BUCKET"],
-        Key=file.s3_object_name,
+    url = s3.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": os.environ["DATASET_S3_BUCKET"],
+            "Key": file.s3_object_name,
+        },
+        ExpiresIn=DOWNLOAD_URL_EXPIRES_IN,
     )
 
-    return StreamingResponse(content=s3_object["Body"].iter_chunks())
+    return RedirectResponse(url=url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
 
 
 def dataset_delete_file(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
 ) -> BasicResponse:
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
+    file_result = session.execute(
+        GET_DATASET_OBJECT_BY_ID, {"guid": file_guid}
+    ).one_or_none()
 
     if not file_result:
         raise HTTPException(
@@ -154,7 +163,7 @@ def dataset_delete_file(
 
     file_object = file_result[0]  # DatasetObject is in the first element of the tuple
 
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
 
     s3.delete_object(
         Bucket=os.environ["DATASET_S3_BUCKET"],
@@ -185,37 +194,44 @@ def dataset_delete_file(
 
 def dataset_file_add_tag(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     tag: Annotated[str, Form(...)] = None,
 ):
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
+    tag_guid = uuid4()
 
-    if not file_result:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="File not found",
+    # only insert when the file exists and doesn't already have the tag, so the
+    # happy path is a single round-trip to the database
+    result = session.execute(
+        insert(DatasetObjectTag).from_select(
+            ["id", "dataset_object_id", "tag"],
+            select(
+                literal(tag_guid, DatasetObjectTag.id.type),
+                DatasetObject.id,
+                literal(tag, DatasetObjectTag.tag.type),
+            ).where(
+                DatasetObject.id == file_guid,
+                ~exists().where(
+                    DatasetObjectTag.dataset_object_id == file_guid,
+                    DatasetObjectTag.tag == tag,
+                ),
+            ),
         )
+    )
+
+    if result.rowcount == 0:
+        file_query = select(DatasetObject.id).where(DatasetObject.id == file_guid)
 
-    existing_tags = file_result[0].tags(session=session)
+        if not session.execute(file_query).one_or_none():
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="File not found",
+            )
 
-    if tag in [t[0].tag for t in existing_tags]:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Tag already exists",
         )
 
-    tag_guid = uuid4()
-
-    session.execute(
-        insert(DatasetObjectTag).values(
-            id=tag_guid,
-            dataset_object_id=file_guid,
-            tag=tag,
-        )
-    )
-
     session.commit()
 
     return {
@@ -230,37 +246,21 @@ def dataset_file_add_tag(
 def dataset_file_delete_tag(
     file_guid: UUID,
     tag_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
 ) -> BasicResponse:
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
-
-    if not file_result:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="File not found",
+    result = session.execute(
+        DatasetObjectTag.__table__.delete().where(
+            DatasetObjectTag.dataset_object_id == file_guid,
+            DatasetObjectTag.id == tag_guid,
         )
-
-    tag_query = select(DatasetObjectTag).where(
-        DatasetObjectTag.dataset_object_id == file_guid,
-        DatasetObjectTag.id == tag_guid,
     )
-    tag_result = session.execute(tag_query).one_or_none()
 
-    if not tag_result:
+    if result.rowcount == 0:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Tag not found",
         )
 
-    session.execute(
-        DatasetObjectTag.__table__.delete().where(
-            DatasetObjectTag.dataset_object_id == file_guid,
-            DatasetObjectTag.id == tag_guid,
-        )
-    )
-
     session.commit()
 
     return {"status": "OK"}
@@ -270,14 +270,14 @@ def dataset_file_add_label(
     file_guid: UUID,
     label: Annotated[str, Form(...)],
     polygon: Annotated[str, Form(...)],
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
 ):
     """Add a label to a file in the dataset. The polygon is a JSON string with a list of nodes in the form of {"x": 0.0, "y": 0.0}.
     X and Y are represented as a percentage of the width and height of the image or video.
     """
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result: DatasetObject = session.execute(file_query).one_or_none()
+    file_result: DatasetObject = session.execute(
+        GET_DATASET_OBJECT_BY_ID, {"guid": file_guid}
+    ).one_or_none()
 
     if not file_result:
         raise HTTPException(
@@ -286,33 +286,21 @@ def dataset_file_add_label(
         )
 
     try:
-        polygon_parsed = json.loads(polygon)
-    except json.JSONDecodeError:
+        polygon_parsed = POLYGON_ADAPTER.validate_json(polygon)
+    except ValidationError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid polygon",
         )
 
-    for node in polygon_parsed:
-        if "left" in node:
-            node["x"] = node["left"]
-            node.pop("left")
-
-        if "top" in node:
-            node["y"] = node["top"]
-            node.pop("top")
-
-        if "x" not in node or "y" not in node:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid polygon: missing x or y",
-            )
-
-    existing_labels = file_result[0].labels(session=session)
+    # store the canonical {"x", "y"} form, polygon_to_tensor doesn't know the aliases
+    polygon_json = orjson.dumps(
+        [point.model_dump() for point in polygon_parsed]
+    ).decode("utf8")
 
-    for existing_label in existing_labels:
-        if existing_label[0].label == label:
-            if existing_label[0].polygon == polygon:
+    for existing_label in file_result[0].labels:
+        if existing_label.label == label:
+            if existing_label.polygon == polygon_json:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="Label already exists",
@@ -325,7 +313,7 @@ def dataset_file_add_label(
             id=label_guid,
             dataset_object_id=file_guid,
             label=label,
-            polygon=polygon,
+            polygon=polygon_json,
         )
     )
 
@@ -341,98 +329,156 @@ def dataset_file_add_label(
     }
 
 
-def dataset_file_delete_label(
+def dataset_file_add_annotations(
     file_guid: UUID,
-    label_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
-) -> BasicResponse:
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
+    labels: Annotated[str, Form(...)],
+    tags: Annotated[list[str], Form(...)] = None,
+):
+    """Add tags and labels to a file in the dataset in one request. Labels is a JSON string with a list of
+    {"label": "...", "polygon": [{"x": 0.0, "y": 0.0}, ...]} objects, polygons as in the labels endpoint.
+    Tags and labels (with the same polygon) the file already has are skipped.
+    """
+    file_query = select(DatasetObject.id).where(DatasetObject.id == file_guid)
 
-    if not file_result:
+    if not session.execute(file_query).one_or_none():
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found",
         )
 
-    label_query = select(DatasetObjectLabel).where(
-        DatasetObjectLabel.dataset_object_id == file_guid,
-        DatasetObjectLabel.id == label_guid,
-    )
-    label_result = session.execute(label_query).one_or_none()
-
-    if not label_result:
+    try:
+        labels_parsed = LABELS_ADAPTER.validate_json(labels)
+    except ValidationError:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Label not found",
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid labels",
         )
 
-    session.execute(
+    new_tags = []
+
+    if tags:
+        existing_tags = set(
+            session.execute(
+                select(DatasetObjectTag.tag).where(
+                    DatasetObjectTag.dataset_object_id == file_guid,
+                    DatasetObjectTag.tag.in_(tags),
+                )
+            ).scalars()
+        )
+
+        new_tags = [
+            {"id": uuid4(), "dataset_object_id": file_guid, "tag": tag}
+            for tag in dict.fromkeys(tags)
+            if tag not in existing_tags
+        ]
+
+        if new_tags:
+            session.execute(insert(DatasetObjectTag), new_tags)
+
+    # labels are compared in the same normalized form dataset_file_add_label stores
+    labels_json = {
+        (
+            label.label,
+            orjson.dumps(
+                [point.model_dump() for point in label.polygon]
+            ).decode("utf8"),
+        ): label
+        for label in labels_parsed
+    }
+
+    existing_labels = set()
+
+    if labels_json:
+        existing_labels = set(
+            session.execute(
+                select(DatasetObjectLabel.label, DatasetObjectLabel.polygon).where(
+                    DatasetObjectLabel.dataset_object_id == file_guid,
+                    DatasetObjectLabel.label.in_(
+                        {label for label, _ in labels_json.keys()}
+                    ),
+                )
+            ).tuples()
+        )
+
+    new_labels = [
+        (
+            {
+                "id": uuid4(),
+                "dataset_object_id": file_guid,
+                "label": label,
+                "polygon": polygon_json,
+            },
+            label_parsed,
+        )
+        for (label, polygon_json), label_parsed in labels_json.items()
+        if (label, polygon_json) not in existing_labels
+    ]
+
+    if new_labels:
+        session.execute(
+            insert(DatasetObjectLabel), [new_label for new_label, _ in new_labels]
+        )
+
+    session.commit()
+
+    return {
+        "status": "OK",
+        "tags": [{"tag_guid": tag["id"], "tag": tag["tag"]} for tag in new_tags],
+        "labels": [
+            {
+                "label_guid": new_label["id"],
+                "label": label.label,
+                "polygon": label.polygon,
+            }
+            for new_label, label in new_labels
+        ],
+    }
+
+
+def dataset_file_delete_label(
+    file_guid: UUID,
+    label_guid: UUID,
+    session: Annotated[Session, Depends(get_local_session)],
+) -> BasicResponse:
+    result = session.execute(
         DatasetObjectLabel.__table__.delete().where(
             DatasetObjectLabel.dataset_object_id == file_guid,
             DatasetObjectLabel.id == label_guid,
         )
     )
 
+    if result.rowcount == 0:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Label not found",
+        )
+
     session.commit()
 
     return {"status": "OK"}
 
 
 def dataset_file_update_label(
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     file_guid: UUID,
     label_guid: UUID,
     label: Annotated[str, Form(...)],
     polygon: Annotated[str, Form(...)],
 ) -> BasicResponse:
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
-
-    if not file_result:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="File not found",
-        )
-
-    label_query = select(DatasetObjectLabel).where(
-        DatasetObjectLabel.dataset_object_id == file_guid,
-        DatasetObjectLabel.id == label_guid,
-    )
-    label_result = session.execute(label_query).one_or_none()
-
-    if not label_result:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Label not found",
-        )
-
     try:
-        polygon_parsed = json.loads(polygon)
-    except json.JSONDecodeError:
+        polygon_parsed = POLYGON_ADAPTER.validate_json(polygon)
+    except ValidationError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid polygon",
         )
 
-    for node in polygon_parsed:
-        if "left" in node:
-            node["x"] = node["left"]
-            node.pop("left")
-
-        if "top" in node:
-            node["y"] = node["top"]
-            node.pop("top")
+    polygon_json = orjson.dumps(
+        [point.model_dump() for point in polygon_parsed]
+    ).decode("utf8")
 
-        if "x" not in node or "y" not in node:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid polygon: missing x or y",
-            )
-
-    session.execute(
+    result = session.execute(
         DatasetObjectLabel.__table__.update()
         .where(
             DatasetObjectLabel.dataset_object_id == file_guid,
@@ -440,9 +486,16 @@ def dataset_file_update_label(
         )
         .values(
             label=label,
-            polygon=polygon,
+            polygon=polygon_json,
         )
     )
+
+    if result.rowcount == 0:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Label not found",
+        )
+
     session.commit()
 
     return {"status": "OK"}
@@ -450,15 +503,11 @@ def dataset_file_update_label(
 
 def dataset_file_details(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
 ) -> DatasetFileDetails:
-    file_query = select(DatasetObject).where(DatasetObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
-
-    file = file_result[0]  # DatasetObject is in the first element of the tuple
-
-    file_as_dict = file.as_dict(session=session)
+    file_result = session.execute(
+        GET_DATASET_OBJECT_DETAILS_BY_ID, {"guid": file_guid}
+    ).one_or_none()
 
     if not file_result:
         raise HTTPException(
@@ -466,14 +515,18 @@ def dataset_file_details(
             detail="File not found",
         )
 
-    return {
-        "status": "OK",
-        "file": file_as_dict,
-    }
+    file = file_result[0]  # DatasetObject is in the first element of the tuple
+
+    # as_dict already matches DatasetFileDetails, so skip validating it again
+    return ORJSONResponse(
+        {
+            "status": "OK",
+            "file": file.as_dict(),
+        }
+    )
 
 
 def dataset_list_files(
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     search_tags: str = None,
     limit: int = None,
@@ -487,7 +540,21 @@ def dataset_list_files(
 
     total_files = session.query(func.count(DatasetObject.id)).scalar()
 
-    files_query = select(DatasetObject).order_by("name")
+    files_query = (
+        select(DatasetObject)
+        .options(
+            selectinload(DatasetObject.tags),
+            selectinload(DatasetObject.labels),
+        )
+        .order_by(DatasetObject.name)
+    )
+
+    if search_tags:
+        files_query = files_query.where(
+            DatasetObject.tags.any(
+                DatasetObjectTag.tag.in_(search_tags.split(","))
+            )
+        )
 
     if limit:
         files_query = files_query.limit(limit)
@@ -495,24 +562,17 @@ def dataset_list_files(
     if offset:
         files_query = files_query.offset(offset)
 
-    files_result = session.execute(files_query).all()
+    files_result = session.execute(files_query).scalars().all()
 
-    files_list = []
+    files_list = [file.as_dict() for file in files_result]
 
-    search_tags_set = frozenset(search_tags.split(",")) if search_tags else {}
-
-    for row in files_result:
-        file = row[0]  # DatasetObject is in the first element of the tuple
-        tags = frozenset([t[0].tag for t in file.tags(session=session)])
-
-        if search_tags and len(tags.intersection(search_tags_set)) > 0:
-            continue
-
-        files_list.append(file.as_dict(session=session))
-
-    return {
-        "status": "OK",
-        "files": files_list,
-        "count": len(files_list),
-        "total_count": total_files,
-    }
+    # everything in the listing is natively serializable by orjson, so skip
+    # FastAPI's jsonable_encoder pass over every file
+    return ORJSONResponse(
+        {
+            "status": "OK",
+            "files": files_list,
+            "count": len(files_list),
+            "total_count": total_files,
+        }
+    )
@@ -1,12 +1,14 @@
 import hashlib
-import json
 import logging
+import orjson
 import os
 import uuid
 
-from sqlalchemy import select, String, Text, UUID, DateTime
+from sqlalchemy import bindparam, lambda_stmt, select, ForeignKey, String, Text, UUID, DateTime
 from sqlalchemy.orm import mapped_column
 from sqlalchemy.orm import Mapped
+from sqlalchemy.orm import relationship
+from sqlalchemy.orm import selectinload
 from sqlalchemy import sql
 
 
@@ -62,6 +64,9 @@ class DatasetObject(Base):
         String(40)
     )  # SHA1 hash of the file to prevent duplicates
 
+    tags: Mapped[list["DatasetObjectTag"]] = relationship()
+    labels: Mapped[list["DatasetObjectLabel"]] = relationship()
+
     def __repr__(self):
         return f"<Dataset(name={self.name}, s3_object_name={self.s3_object_name}>"
 
@@ -71,11 +76,8 @@ class DatasetObject(Base):
     @classmethod
     def polygon_string_to_json(cls, polygon_string: str) -> list[dict]:
         try:
-            polygon_list = json.loads(polygon_string)
-        except json.JSONDecodeError:
-            logger.error(f"Error decoding JSON string: {polygon_string}")
-            polygon_list = []
-        except TypeError:
+            polygon_list = orjson.loads(polygon_string)
+        except orjson.JSONDecodeError:
             logger.error(f"Error decoding JSON string: {polygon_string}")
             polygon_list = []
 
@@ -112,7 +114,7 @@ class DatasetObject(Base):
 
         return clean_list
 
-    def as_dict(self, session):
+    def as_dict(self):
         return {
             "id": self.id,
             "name": self.name,
@@ -124,46 +126,28 @@ class DatasetObject(Base):
             "tags": sorted(
                 [
                     {
-                        "tag_guid": t[0].id,
-                        "tag": t[0].tag,
+                        "tag_guid": t.id,
+                        "tag": t.tag,
                     }
-                    for t in self.tags(session)
+                    for t in self.tags
                 ],
                 key=lambda x: x["tag"],
             ),
             "labels": sorted(
                 [
                     {
-                        "label_guid": l[0].id,
-                        "label": l[0].label,
+                        "label_guid": l.id,
+                        "label": l.label,
                         "polygon": DatasetObject.polygon_string_to_json(
-                            l[0].polygon or "[]"
+                            l.polygon or "[]"
                         ),
                     }
-                    for l in self.labels(session)
+                    for l in self.labels
                 ],
                 key=lambda x: x["label"],
             ),
         }
 
-    def tags(self, session):
-        stmt = select(DatasetObjectTag).where(
-            DatasetObjectTag.dataset_object_id == self.id
-        )
-
-        result = session.execute(stmt)
-
-        return result.all()
-
-    def labels(self, session):
-        stmt = select(DatasetObjectLabel).where(
-            DatasetObjectLabel.dataset_object_id == self.id
-        )
-
-        result = session.execute(stmt)
-
-        return result.all()
-
 
 class DatasetObjectTag(Base):
     __tablename__ = "dataset_object_tags"
@@ -171,7 +155,9 @@ class DatasetObjectTag(Base):
     id: Mapped[uuid.UUID] = mapped_column(
         UUID(as_uuid=True), primary_key=True, index=True
     )
-    dataset_object_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), index=True)
+    dataset_object_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("dataset_objects.id"), index=True
+    )
     tag: Mapped[str] = mapped_column(String(64), index=True)
 
     def __repr__(self):
@@ -187,7 +173,9 @@ class DatasetObjectLabel(Base):
     id: Mapped[uuid.UUID] = mapped_column(
         UUID(as_uuid=True), primary_key=True, index=True
     )
-    dataset_object_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), index=True)
+    dataset_object_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("dataset_objects.id"), index=True
+    )
     label: Mapped[str] = mapped_column(String(128), index=True)
     polygon: Mapped[str] = mapped_column(Text)
 
@@ -208,30 +196,23 @@ class MLModelObject(Base):
     s3_object_name: Mapped[str] = mapped_column(String(512), unique=True, index=True)
     content_type = mapped_column(String(128))
 
+    tags: Mapped[list["MLModelObjectTag"]] = relationship()
+
     def __repr__(self):
         return f"<MLModel(name={self.name}, s3_object_name={self.s3_object_name}>"
 
     def __str__(self):
         return f"<MLModel(name={self.name}, s3_object_name={self.s3_object_name}>"
 
-    def as_dict(self, session):
+    def as_dict(self):
         return {
             "id": self.id,
             "name": self.name,
             "s3_object_name": self.s3_object_name,
             "content_type": self.content_type,
-            "tags": set([t[0].tag for t in self.tags()]),
+            "tags": sorted(set(t.tag for t in self.tags)),
         }
 
-    def tags(self, session):
-        stmt = select(MLModelObjectTag).where(
-            MLModelObjectTag.mlmodel_object_id == self.id
-        )
-
-        result = session.execute(stmt)
-
-        return result.all()
-
 
 class MLModelObjectTag(Base):
     __tablename__ = "mlmodel_object_tags"
@@ -239,7 +220,9 @@ class MLModelObjectTag(Base):
     id: Mapped[uuid.UUID] = mapped_column(
         UUID(as_uuid=True), primary_key=True, index=True
     )
-    mlmodel_object_id: Mapped[uuid.UUID] = mapped_column(UUID(as_uuid=True), index=True)
+    mlmodel_object_id: Mapped[uuid.UUID] = mapped_column(
+        UUID(as_uuid=True), ForeignKey("mlmodel_objects.id"), index=True
+    )
     tag: Mapped[str] = mapped_column(String(64), index=True)
 
     def __repr__(self):
@@ -247,3 +230,33 @@ class MLModelObjectTag(Base):
 
     def __str__(self):
         return f"<MLModelObjectTag(model_object_id={self.mlmodel_object_id}, tag={self.tag}>"
+
+
+# statements used on every request are built once as lambda statements so
+# SQLAlchemy can reuse the compiled SQL instead of rebuilding it each time
+GET_API_CREDENTIALS_BY_KEY = lambda_stmt(
+    lambda: select(APICredentials).where(
+        APICredentials.api_key == bindparam("api_key")
+    )
+)
+
+GET_DATASET_OBJECT_BY_ID = lambda_stmt(
+    lambda: select(DatasetObject).where(DatasetObject.id == bindparam("guid"))
+)
+
+# the details endpoint is the only single-file lookup that reads tags and labels
+GET_DATASET_OBJECT_DETAILS_BY_ID = lambda_stmt(
+    lambda: select(DatasetObject)
+    .options(selectinload(DatasetObject.tags), selectinload(DatasetObject.labels))
+    .where(DatasetObject.id == bindparam("guid"))
+)
+
+GET_DATASET_OBJECT_BY_SHA1 = lambda_stmt(
+    lambda: select(DatasetObject).where(
+        DatasetObject.file_hash_sha1 == bindparam("sha1")
+    )
+)
+
+GET_MLMODEL_OBJECT_BY_ID = lambda_stmt(
+    lambda: select(MLModelObject).where(MLModelObject.id == bindparam("guid"))
+)
@@ -1,19 +1,18 @@
+import contextlib
 import dotenv
 import os
 
 dotenv.load_dotenv()
 
 from fastapi import (
+    APIRouter,
     Depends,
     FastAPI,
 )
 
-from fastapi.security import HTTPBasicCredentials
-from mimetypes import init as mimetypes_init
+from fastapi.responses import ORJSONResponse
 
-from typing import Annotated
-
-from .auth import authenticate_user
+from .auth import authenticate_user, login
 from .types import (
     BasicResponse,
     InferenceResponse,
@@ -24,6 +23,7 @@ from .dataset import (
     dataset_list_files,
     dataset_file_details,
     dataset_download_file,
+    dataset_file_add_annotations,
     dataset_file_add_label,
     dataset_file_add_tag,
     dataset_file_update_label,
@@ -31,7 +31,7 @@ from .dataset import (
     dataset_file_delete_tag,
     dataset_delete_file,
 )
-from .ml.ml import model_inference
+from .ml.ml import configure_torch_threads, model_inference
 from .model import (
     model_upload_file,
     model_download_file,
@@ -42,11 +42,18 @@ from .model import (
 )
 
 
-mimetypes_init()
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_torch_threads()
+    yield
+
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 app.debug = os.getenv("DEBUG", False)
 
+# every route on this router requires a valid API key
+router = APIRouter(dependencies=[Depends(authenticate_user)])
+
 
 @app.get("/")
 def get_index() -> BasicResponse:
@@ -54,15 +61,23 @@ def get_index() -> BasicResponse:
     return {"status": "OK"}
 
 
-@app.post("/")
-def post_index(
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
-) -> BasicResponse:
+app.add_api_route(
+    path="/login",
+    endpoint=login,
+    methods=["POST"],
+    response_model=BasicResponse,
+    summary="Get a session cookie.",
+    description=login.__doc__,
+)
+
+
+@router.post("/")
+def post_index() -> BasicResponse:
     """A simple health check endpoint to make sure that the API is up and running with authentication."""
     return {"status": "OK"}
 
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset",
     endpoint=dataset_list_files,
     methods=["GET"],
@@ -70,7 +85,7 @@ app.add_api_route(
     description=dataset_list_files.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset",
     endpoint=dataset_upload_file,
     methods=["POST"],
@@ -79,7 +94,7 @@ app.add_api_route(
     response_model=UploadFileResponse,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset/{file_guid}/details",
     endpoint=dataset_file_details,
     methods=["GET"],
@@ -87,7 +102,7 @@ app.add_api_route(
     description=dataset_file_details.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset/{file_guid}/labels/{label_guid}",
     endpoint=dataset_file_update_label,
     methods=["PUT"],
@@ -96,7 +111,7 @@ app.add_api_route(
     description=dataset_file_update_label.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset/{file_guid}/labels/{label_guid}",
     endpoint=dataset_file_delete_label,
     methods=["DELETE"],
@@ -105,7 +120,7 @@ app.add_api_route(
     description=dataset_file_delete_label.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset/{file_guid}/labels",
     endpoint=dataset_file_add_label,
     methods=["POST"],
@@ -113,7 +128,15 @@ app.add_api_route(
     description=dataset_file_add_label.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
+    path="/dataset/{file_guid}/annotations",
+    endpoint=dataset_file_add_annotations,
+    methods=["POST"],
+    summary="Add tags and labels to a dataset file in one request.",
+    description=dataset_file_add_annotations.__doc__,
+)
+
+router.add_api_route(
     path="/dataset/{file_guid}",
     endpoint=dataset_download_file,
     methods=["GET"],
@@ -121,7 +144,7 @@ app.add_api_route(
     description=dataset_download_file.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset/{file_guid}",
     endpoint=dataset_delete_file,
     methods=["DELETE"],
@@ -130,7 +153,7 @@ app.add_api_route(
     description=dataset_delete_file.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset/{file_guid}/tags",
     endpoint=dataset_file_add_tag,
     methods=["POST"],
@@ -138,7 +161,7 @@ app.add_api_route(
     description=dataset_file_add_tag.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/dataset/{file_guid}/tags/{tag_guid}",
     endpoint=dataset_file_delete_tag,
     methods=["DELETE"],
@@ -147,7 +170,7 @@ app.add_api_route(
     description=dataset_file_delete_tag.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/models",
     endpoint=model_upload_file,
     methods=["POST"],
@@ -155,7 +178,7 @@ app.add_api_route(
     description=model_upload_file.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/models",
     endpoint=model_list_files,
     methods=["GET"],
@@ -163,7 +186,7 @@ app.add_api_route(
     description=model_list_files.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/models/{file_guid}",
     endpoint=model_download_file,
     methods=["GET"],
@@ -171,7 +194,7 @@ app.add_api_route(
     description=model_download_file.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/models/{file_guid}",
     endpoint=model_delete_file,
     methods=["DELETE"],
@@ -180,7 +203,7 @@ app.add_api_route(
     description=model_delete_file.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/models/{file_guid}/tags",
     endpoint=model_file_add_tag,
     methods=["POST"],
@@ -188,7 +211,7 @@ app.add_api_route(
     description=model_file_add_tag.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/models/{file_guid}/tags/{tag_guid}",
     endpoint=model_file_delete_tag,
     methods=["DELETE"],
@@ -197,7 +220,7 @@ app.add_api_route(
     description=model_file_delete_tag.__doc__,
 )
 
-app.add_api_route(
+router.add_api_route(
     path="/models/{file_guid}/inference",
     endpoint=model_inference,
     methods=["POST"],
@@ -205,3 +228,5 @@ app.add_api_route(
     response_model=InferenceResponse,
     description=model_inference.__doc__,
 )
+
+app.include_router(router)
@@ -0,0 +1,85 @@
+import argparse
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import torch
+
+from sqlalchemy import select
+
+from ..db.engine import SessionLocal
+from ..db.models import MLModelObject
+from ..storage import get_s3_client
+
+
+def convert_checkpoint(model_data) -> bytes:
+    """Re-saves a checkpoint in the torchvision reference format (model, optimizer,
+    lr_scheduler, args, epoch) as just {"model": state_dict}, which load_model can read
+    with weights_only=True. Returns None if the checkpoint can be loaded as it is.
+    """
+    try:
+        torch.load(model_data, map_location=torch.device("cpu"), weights_only=True)
+        return None
+    except pickle.UnpicklingError:
+        model_data.seek(0)
+
+    # a full unpickle, so this is only for the bucket's own trusted checkpoints
+    checkpoint = torch.load(model_data, map_location=torch.device("cpu"))
+
+    converted = io.BytesIO()
+    torch.save({"model": checkpoint["model"]}, converted)
+
+    return converted.getvalue()
+
+
+def convert_checkpoints(dry_run: bool = False) -> None:
+    s3 = get_s3_client()
+    bucket = os.environ["MLMODEL_S3_BUCKET"]
+
+    with SessionLocal() as session:
+        models = session.execute(select(MLModelObject)).scalars().all()
+
+    for model in models:
+        s3_object = s3.get_object(Bucket=bucket, Key=model.s3_object_name)
+
+        with tempfile.NamedTemporaryFile(suffix=".pth") as model_file:
+            shutil.copyfileobj(s3_object["Body"], model_file, length=1024 * 1024)
+            model_file.seek(0)
+
+            try:
+                converted = convert_checkpoint(model_file)
+            except Exception as e:
+                print(f"skipping {model.name} ({model.id}), not a checkpoint: {e}")
+                continue
+
+        if converted is None:
+            print(f"{model.name} ({model.id}) already loads")
+            continue
+
+        print(f"converting {model.name} ({model.id})")
+
+        if not dry_run:
+            s3.put_object(
+                Bucket=bucket,
+                Key=model.s3_object_name,
+                Body=converted,
+                ContentType=model.content_type or "application/octet-stream",
+            )
+
+
+if __name__ == "__main__":
+    import dotenv
+
+    dotenv.load_dotenv()
+
+    parser = argparse.ArgumentParser(
+        description="Re-save uploaded model checkpoints so the API can load them."
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only list the checkpoints that would be converted",
+    )
+
+    convert_checkpoints(dry_run=parser.parse_args().dry_run)
@@ -1,33 +1,56 @@
-import boto3
+import argparse
+import collections
 import cv2
 import io
-import json
-import numpy as np
+import itertools
+import orjson
 import os
+import pickle
+import pytest
+import threading
+import time
+import torch
 
-from ..db.commands.create_api_key import create_api_key
-from ..main import app
-from .ml import detect_defects, train_model
+from . import ml
+from .convert_checkpoints import convert_checkpoint
+from .ml import InferenceBatcher, detect_defects, load_model, train_model
 
-from fastapi.testclient import TestClient
-from moto import mock_s3
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageFilter
+from uuid import uuid4
 
 TEST_PATH = os.path.dirname(os.path.realpath(__file__))
+TEST_IMAGE_PATH = os.path.join(TEST_PATH, "test_fixtures", "110.bmp")
+TEST_MODEL_PATH = os.path.join(TEST_PATH, "test_fixtures", "model.pth")
 
-client = TestClient(app)
+TRAIN_POLYGON_JSON = orjson.dumps(
+    [
+        {"x": 0.1, "y": 0.1},
+        {"x": 0.9, "y": 0.1},
+        {"x": 0.9, "y": 0.9},
+        {"x": 0.1, "y": 0.9},
+    ]
+).decode("utf8")
 
 
-def test_detect_defects():
+@pytest.fixture(scope="session")
+def test_image():
+    """The fixture image, decoded once for every test that needs the pixels."""
+    return cv2.imread(TEST_IMAGE_PATH)
+
+
+@pytest.fixture(scope="session")
+def test_model():
+    """The fixture model, loaded once since scripting and warming it up is slow."""
+    with open(TEST_MODEL_PATH, "rb") as f:
+        return load_model(f)
+
+
+def test_detect_defects(test_image, test_model):
     """Test the detect_defects function actually runs. We're not testing the
     accuracy of the model, just that it functions as expected.
     """
-    image = cv2.imread(os.path.join(TEST_PATH, "test_fixtures", "110.bmp"))
-
-    model_path = os.path.join(TEST_PATH, "test_fixtures", "model.pth")
-
-    with open(model_path, "rb") as f:
-        predictions = detect_defects(image, f)
+    predictions = detect_defects(test_image, test_model)
 
     print(predictions)
 
@@ -45,25 +68,115 @@ def test_detect_defects():
             assert "end_frame" in point
 
 
-@mock_s3
-def test_model_file_inference():
-    api_key, secret = create_api_key("test_model_file_inference")
+def test_inference_batcher():
+    batch_sizes = []
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["MLMODEL_S3_BUCKET"])
+    def fake_model(images):
+        batch_sizes.append(len(images))
+        # calls that arrive while a forward pass runs are the ones that get batched
+        time.sleep(0.05)
+        return {}, [{"image": image} for image in images]
 
-    model_path = os.path.join(TEST_PATH, "test_fixtures", "model.pth")
+    batcher = InferenceBatcher(fake_model, max_batch_size=4, max_wait=0.05)
 
-    with open(model_path, "rb") as f:
-        model_contents = f.read()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: batcher([i]), range(8)))
 
-    response = client.post(
-        "/models",
-        files={"file": ("test_model.pth", model_contents)},
-        data={"tags": ["test"]},
-        auth=(api_key, secret),
+    # every caller gets back only its own detections
+    assert [detections for _, detections in results] == [
+        [{"image": i}] for i in range(8)
+    ]
+
+    assert sum(batch_sizes) == 8
+    assert max(batch_sizes) <= 4
+    assert len(batch_sizes) < 8
+
+
+def test_inference_batcher_solo_call_does_not_wait():
+    batcher = InferenceBatcher(
+        lambda images: ({}, [{"image": image} for image in images]), max_wait=5.0
+    )
+
+    start = time.monotonic()
+    _, detections = batcher([0])
+
+    assert detections == [{"image": 0}]
+    assert time.monotonic() - start < 1.0
+
+
+@pytest.mark.parametrize(
+    "fake_output",
+    [
+        # one detection short for the batch
+        lambda images: ({}, [{"image": image} for image in images[1:]]),
+        # not the (losses, detections) pair the scripted model returns
+        lambda images: None,
+    ],
+)
+def test_inference_batcher_bad_model_output(fake_output):
+    def fake_model(images):
+        time.sleep(0.05)
+        return fake_output(images)
+
+    batcher = InferenceBatcher(fake_model, max_batch_size=4, max_wait=0.05)
+
+    # every caller, not just the one that ran the batch, gets the error back
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(batcher, [i]) for i in range(8)]
+
+        for future in futures:
+            with pytest.raises((TypeError, ValueError)):
+                future.result(timeout=5)
+
+
+def test_get_model_cache_hit_does_not_wait_for_a_load(monkeypatch):
+    loading = threading.Event()
+    release = threading.Event()
+
+    def fake_download(s3_object_name):
+        if s3_object_name == "slow":
+            loading.set()
+            release.wait(5)
+
+        return s3_object_name
+
+    monkeypatch.setattr(ml, "_download_model", fake_download)
+    monkeypatch.setattr(ml, "_model_cache", collections.OrderedDict())
+
+    # a model that shares the slow model's slot in the lock pool
+    slot = hash("slow") % len(ml._MODEL_LOCKS)
+    cached_name = next(
+        name
+        for name in (f"model-{i}" for i in itertools.count())
+        if hash(name) % len(ml._MODEL_LOCKS) == slot
     )
 
+    assert ml.get_model(cached_name) == cached_name
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slow_model = executor.submit(ml.get_model, "slow")
+        assert loading.wait(5)
+
+        start = time.monotonic()
+        assert ml.get_model(cached_name) == cached_name
+        assert time.monotonic() - start < 1.0
+
+        release.set()
+        assert slow_model.result(timeout=5) == "slow"
+
+
+def test_model_file_inference(client, auth):
+    api_key, secret = auth
+
+    # hand the client the open file so it streams it rather than a copy in memory
+    with open(TEST_MODEL_PATH, "rb") as f:
+        response = client.post(
+            "/models",
+            files={"file": ("test_model.pth", f)},
+            data={"tags": ["test"]},
+            auth=(api_key, secret),
+        )
+
     assert response.status_code == 200
     response_json = response.json()
 
@@ -71,73 +184,104 @@ def test_model_file_inference():
 
     model_object_id = response_json["model_object_id"]
 
-    image_path = os.path.join(TEST_PATH, "test_fixtures", "110.bmp")
+    with open(TEST_IMAGE_PATH, "rb") as f:
+        response = client.post(
+            f"/models/{model_object_id}/inference",
+            files={"file": ("test_image.bmp", f)},
+            auth=(api_key, secret),
+        )
+
+    assert response.status_code == 200
+
+    response_json = response.json()
+
+    assert response_json["status"] == "OK"
+    assert len(response_json["predictions"]) == 8
+
+
+@pytest.fixture(scope="session")
+def reference_checkpoint():
+    """A checkpoint as the torchvision reference scripts save it, with the argparse
+    namespace of the training run next to the weights."""
+    checkpoint = io.BytesIO()
+
+    torch.save(
+        {"model": {}, "args": argparse.Namespace(epochs=1), "epoch": 0}, checkpoint
+    )
+
+    return checkpoint.getvalue()
+
+
+def test_load_model_rejects_pickled_args(reference_checkpoint):
+    with pytest.raises(pickle.UnpicklingError):
+        load_model(io.BytesIO(reference_checkpoint))
+
 
-    with open(image_path, "rb") as f:
-        image_contents = f.read()
+def test_convert_checkpoint(reference_checkpoint):
+    converted = convert_checkpoint(io.BytesIO(reference_checkpoint))
+
+    assert torch.load(io.BytesIO(converted), weights_only=True) == {"model": {}}
+
+    # already converted checkpoints are left alone
+    assert convert_checkpoint(io.BytesIO(converted)) is None
+
+
+def test_model_file_inference_pickled_args(client, auth, reference_checkpoint):
+    api_key, secret = auth
 
     response = client.post(
-        f"/models/{model_object_id}/inference",
-        files={"file": ("test_image.bmp", image_contents)},
+        "/models",
+        files={"file": ("reference_model.pth", reference_checkpoint)},
+        data={"tags": ["test"]},
         auth=(api_key, secret),
     )
 
     assert response.status_code == 200
+    model_object_id = response.json()["model_object_id"]
 
-    response_json = response.json()
-
-    assert response_json["status"] == "OK"
-    assert len(response_json["predictions"]) == 8
+    with open(TEST_IMAGE_PATH, "rb") as f:
+        response = client.post(
+            f"/models/{model_object_id}/inference",
+            files={"file": ("test_image.bmp", f)},
+            auth=(api_key, secret),
+        )
 
+    assert response.status_code == 400
+    assert "re-save" in response.json()["detail"]
 
-@mock_s3
-def test_train_model():
-    api_key, secret = create_api_key("test_train_model")
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
+def test_train_model(client, auth, upload_many):
+    base_image = Image.open(TEST_IMAGE_PATH)
 
-    image_path = os.path.join(TEST_PATH, "test_fixtures", "110.bmp")
+    # train only on the images uploaded here, other tests put files in the dataset
+    # that aren't images
+    train_tag = f"train-{uuid4()}"
 
-    base_image = Image.open(image_path)
+    images = []
 
-    for i in range(72):
+    for i in range(8):
         loud_image = base_image.filter(ImageFilter.GaussianBlur([i, i]))
 
         image_bytes = io.BytesIO()
         loud_image.save(image_bytes, format="BMP")
 
-        upload_response = client.post(
-            "/dataset",
-            files={"file": (f"test_file_{i}.bmp", image_bytes.getvalue())},
-            data={"tags": ["test"]},
-            auth=(api_key, secret),
-        )
+        images.append((f"test_file_{i}.bmp", image_bytes.getvalue(), [train_tag]))
 
+    for upload_response in upload_many(images):
         assert upload_response.status_code == 200
-        upload_response_json = upload_response.json()
-
-        assert upload_response_json["status"] == "OK"
-        dataset_object_id = upload_response_json["dataset_object_id"]
+        dataset_object_id = upload_response.json()["dataset_object_id"]
 
         add_label_response = client.post(
             f"/dataset/{dataset_object_id}/labels",
             data={
                 "label": "test label",
-                "polygon": json.dumps(
-                    [
-                        {"x": 0.1, "y": 0.1},
-                        {"x": 0.9, "y": 0.1},
-                        {"x": 0.9, "y": 0.9},
-                        {"x": 0.1, "y": 0.9},
-                    ]
-                ),
+                "polygon": TRAIN_POLYGON_JSON,
             },
-            auth=(api_key, secret),
+            auth=auth,
         )
 
         assert add_label_response.status_code == 200
 
-    train_ret = train_model()
+    train_ret = train_model(tags=[train_tag], epochs=1, num_workers=0)
 
     assert train_ret == True
@@ -1,4 +1,3 @@
-import boto3
 import os
 
 from fastapi import (
@@ -9,39 +8,43 @@ from fastapi import (
     status,
 )
 from fastapi.exceptions import HTTPException
-from fastapi.responses import StreamingResponse
-from fastapi.security import HTTPBasicCredentials
-from sqlalchemy import insert, select
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse, RedirectResponse
+from sqlalchemy import insert, literal, select
+from sqlalchemy.orm import Session, selectinload
 from typing import Annotated
 from uuid import uuid4, UUID
 
-from .auth import authenticate_user
 from .db.engine import get_local_session
 from .db.models import (
+    GET_MLMODEL_OBJECT_BY_ID,
     MLModelObject,
     MLModelObjectTag,
 )
+from .storage import get_s3_client, guess_content_type, upload_file
 from .types import BasicResponse
 
+# downloads are redirected to S3, so the presigned URL only needs to outlive the redirect
+DOWNLOAD_URL_EXPIRES_IN = 300
+
 
 def model_upload_file(
     file: Annotated[UploadFile, File(...)],
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     tags: Annotated[list[str], Form(...)] = None,
 ):
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
 
     file_name = file.filename
-    content_type = file.content_type
+    content_type = guess_content_type(file.filename, file.content_type)
 
     s3_object_name = f"{uuid4()}-{file_name}"
 
-    s3.upload_fileobj(
+    upload_file(
+        s3,
         file.file,
         os.environ["MLMODEL_S3_BUCKET"],
         s3_object_name,
+        content_type=content_type,
     )
 
     mo_result = session.execute(
@@ -56,14 +59,10 @@ def model_upload_file(
     mo_id = mo_result.inserted_primary_key[0]
 
     if tags:
-        for tag in tags:
-            session.execute(
-                insert(MLModelObjectTag).values(
-                    id=uuid4(),
-                    mlmodel_object_id=mo_id,
-                    tag=tag,
-                )
-            )
+        session.execute(
+            insert(MLModelObjectTag),
+            [{"id": uuid4(), "mlmodel_object_id": mo_id, "tag": tag} for tag in tags],
+        )
 
     session.commit()
 
@@ -76,11 +75,11 @@ def model_upload_file(
 
 def model_download_file(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
 ):
-    file_query = select(MLModelObject).where(MLModelObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
+    file_result = session.execute(
+        GET_MLMODEL_OBJECT_BY_ID, {"guid": file_guid}
+    ).one_or_none()
 
     if not file_result:
         raise HTTPException(
@@ -90,59 +89,58 @@ def model_download_file(
 
     file = file_result[0]  # ModelObject is in the first element of the tuple
 
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
 
-    s3_object = s3.get_object(
-        Bucket=os.environ["MLMODEL_S3_BUCKET"],
-        Key=file.s3_object_name,
+    url = s3.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": os.environ["MLMODEL_S3_BUCKET"],
+            "Key": file.s3_object_name,
+        },
+        ExpiresIn=DOWNLOAD_URL_EXPIRES_IN,
     )
 
-    return StreamingResponse(content=s3_object["Body"].iter_chunks())
+    return RedirectResponse(url=url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
 
 
 def model_list_files(
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     search_tags: Annotated[list[str], Form(...)] = None,
 ):
     """List all files in the model."""
-    files_query = select(MLModelObject).order_by("name")
-    files_result = session.execute(files_query).all()
-
-    files_list = []
-    search_tags_set = frozenset(search_tags) if search_tags else {}
-
-    for row in files_result:
-        file = row[0]  # ModelObject is in the first element of the tuple
-        tags = frozenset([t[0].tag for t in file.tags(session=session)])
-
-        if search_tags and len(tags.intersection(search_tags_set)) > 0:
-            continue
-
-        files_list.append(
-            {
-                "id": file.id,
-                "name": file.name,
-                "s3_object_name": file.s3_object_name,
-                "content_type": file.content_type,
-                "tags": tags,
-            }
+    files_query = (
+        select(MLModelObject)
+        .options(selectinload(MLModelObject.tags))
+        .order_by(MLModelObject.name)
+    )
+
+    if search_tags:
+        files_query = files_query.where(
+            MLModelObject.tags.any(MLModelObjectTag.tag.in_(search_tags))
         )
 
-    return {
-        "status": "OK",
-        "files": files_list,
-        "count": len(files_list),
-    }
+    files_result = session.execute(files_query).scalars().all()
+
+    files_list = [file.as_dict() for file in files_result]
+
+    # everything in the listing is natively serializable by orjson, so skip
+    # FastAPI's jsonable_encoder pass over every file
+    return ORJSONResponse(
+        {
+            "status": "OK",
+            "files": files_list,
+            "count": len(files_list),
+        }
+    )
 
 
 def model_delete_file(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
 ) -> BasicResponse:
-    file_query = select(MLModelObject).where(MLModelObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
+    file_result = session.execute(
+        GET_MLMODEL_OBJECT_BY_ID, {"guid": file_guid}
+    ).one_or_none()
 
     if not file_result:
         raise HTTPException(
@@ -152,7 +150,7 @@ def model_delete_file(
 
     file_object = file_result[0]  # ModelObject is in the first element of the tuple
 
-    s3 = boto3.client("s3")
+    s3 = get_s3_client()
 
     s3.delete_object(
         Bucket=os.environ["MLMODEL_S3_BUCKET"],
@@ -176,28 +174,29 @@ def model_delete_file(
 
 def model_file_add_tag(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     tag: Annotated[str, Form(...)],
 ):
-    file_query = select(MLModelObject).where(MLModelObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
+    tag_guid = uuid4()
 
-    if not file_result:
+    # only insert when the model exists, so the happy path is a single round-trip
+    result = session.execute(
+        insert(MLModelObjectTag).from_select(
+            ["id", "mlmodel_object_id", "tag"],
+            select(
+                literal(tag_guid, MLModelObjectTag.id.type),
+                MLModelObject.id,
+                literal(tag, MLModelObjectTag.tag.type),
+            ).where(MLModelObject.id == file_guid),
+        )
+    )
+
+    if result.rowcount == 0:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="File not found",
         )
 
-    tag_guid = uuid4()
-    session.execute(
-        insert(MLModelObjectTag).values(
-            id=tag_guid,
-            mlmodel_object_id=file_guid,
-            tag=tag,
-        )
-    )
-
     session.commit()
 
     return {
@@ -211,37 +210,22 @@ def model_file_add_tag(
 
 def model_file_delete_tag(
     file_guid: UUID,
-    credentials: Annotated[HTTPBasicCredentials, Depends(authenticate_user)],
     session: Annotated[Session, Depends(get_local_session)],
     tag_guid: UUID,
 ) -> BasicResponse:
-    file_query = select(MLModelObject).where(MLModelObject.id == file_guid)
-    file_result = session.execute(file_query).one_or_none()
-
-    if not file_result:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="File not found",
+    result = session.execute(
+        MLModelObjectTag.__table__.delete().where(
+            MLModelObjectTag.mlmodel_object_id == file_guid,
+            MLModelObjectTag.id == tag_guid,
         )
-
-    tag_query = select(MLModelObjectTag).where(
-        MLModelObjectTag.mlmodel_object_id == file_guid,
-        MLModelObjectTag.id == tag_guid,
     )
-    tag_result = session.execute(tag_query).one_or_none()
 
-    if not tag_result:
+    if result.rowcount == 0:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Tag not found",
         )
 
-    session.execute(
-        MLModelObjectTag.__table__.delete().where(
-            MLModelObjectTag.mlmodel_object_id == file_guid,
-            MLModelObjectTag.id == tag_guid,
-        )
-    )
     session.commit()
 
     return {"status": "OK"}
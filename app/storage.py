@@ -0,0 +1,98 @@
+import boto3
+import functools
+import logging
+import os
+
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+# S3 requires parts of at least 5 MiB, bigger parts mean fewer requests per upload
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
+
+# the handful of file types the API stores, so there's no need to load the
+# system mime.types database in every worker
+CONTENT_TYPES = {
+    "bmp": "image/bmp",
+    "csv": "text/csv",
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "json": "application/json",
+    "mp4": "video/mp4",
+    "onnx": "application/octet-stream",
+    "png": "image/png",
+    "pt": "application/octet-stream",
+    "pth": "application/octet-stream",
+    "safetensors": "application/octet-stream",
+    "xml": "application/xml",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    """Returns the S3 client shared by every request, so each one reuses the same
+    botocore session and pool of keep-alive connections instead of building its own.
+    """
+    return boto3.client(
+        "s3",
+        config=Config(
+            max_pool_connections=64,
+            tcp_keepalive=True,
+            retries={"max_attempts": 3, "mode": "adaptive"},
+        ),
+    )
+
+
+def guess_content_type(file_name: str, default: str = None) -> str:
+    """Returns the content type for a file name based on its extension, falling back to
+    the given default (usually what the client sent) and then application/octet-stream.
+    """
+    extension = os.path.splitext(file_name)[1].lower().lstrip(".")
+
+    return CONTENT_TYPES.get(extension) or default or "application/octet-stream"
+
+
+def upload_file(s3, fileobj, bucket: str, key: str, content_type: str = None):
+    """Uploads a file object to S3. Anything smaller than one part is sent with a single
+    PutObject, larger files are sent as a multipart upload read straight from the file object.
+    """
+    extra_args = {"ContentType": content_type} if content_type else {}
+
+    data = fileobj.read(UPLOAD_PART_SIZE)
+
+    if len(data) < UPLOAD_PART_SIZE:
+        s3.put_object(Bucket=bucket, Key=key, Body=data, **extra_args)
+        return
+
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)[
+        "UploadId"
+    ]
+
+    parts = []
+
+    try:
+        while data:
+            part_number = len(parts) + 1
+
+            part = s3.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+
+            parts.append({"ETag": part["ETag"], "PartNumber": part_number})
+
+            data = fileobj.read(UPLOAD_PART_SIZE)
+
+        s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except Exception:
+        logger.error(f"Aborting multipart upload of {key}")
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
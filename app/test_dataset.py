@@ -1,39 +1,33 @@
-import boto3
-import hashlib
-import io
-import json
-import os
+import itertools
+import orjson
+import pytest
 import random
+import requests
 
-from fastapi.testclient import TestClient
-from moto import mock_s3
+from uuid import uuid4
 
-from .main import app
-from .db.commands.create_api_key import create_api_key
+from .conftest import TEST_PAYLOAD
 
-client = TestClient(app)
 
+# only the details test uploads TEST_PAYLOAD as-is, so it can check the sha1
+EXPECTED_SHA1 = "c8d7d0ef0eedfa82d2ea1aa592845b9a6d4b02b7"
 
-def generate_random_bytes():
-    return os.urandom(64)
+payload_counter = itertools.count()
 
+EXPECTED_POLYGON = [{"x": 0.1, "y": 0.1}, {"x": 0.9, "y": 0.1}]
+POLYGON_JSON = orjson.dumps(EXPECTED_POLYGON).decode("utf8")
 
-@mock_s3
-def test_dataset_upload_file():
-    api_key, secret = create_api_key("test_dataset_upload_file")
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
+def unique_payload():
+    return TEST_PAYLOAD + next(payload_counter).to_bytes(8, "little")
 
-    test_file_contents = generate_random_bytes()
-
-    test_file = io.BytesIO(test_file_contents)
 
+def upload_file(client, auth, file_contents, tags=("test",)):
     response = client.post(
         "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test"]},
-        auth=(api_key, secret),
+        files={"file": ("test_file.csv", file_contents)},
+        data={"tags": list(tags)},
+        auth=auth,
     )
 
     assert response.status_code == 200
@@ -41,103 +35,47 @@ def test_dataset_upload_file():
 
     assert response_json["status"] == "OK"
 
-    s3_object_name = response_json["s3_object_name"]
-
-    s3_object = s3_client.get_object(
-        Bucket=os.environ["DATASET_S3_BUCKET"],
-        Key=s3_object_name,
-    )
-
-    assert s3_object["Body"].read() == test_file_contents
-
-
-@mock_s3
-def test_dataset_upload_file_no_auth():
-    test_file_contents = generate_random_bytes()
-
-    response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file_contents)},
-    )
-
-    assert response.status_code == 401
-    response_json = response.json()
-
-    assert response_json["detail"] == "Not authenticated"
-
-
-@mock_s3
-def test_dataset_upload_file_no_file():
-    api_key, secret = create_api_key("test_dataset_upload_file")
-
-    response = client.post(
-        "/dataset",
-        auth=(api_key, secret),
-    )
+    return response_json
 
-    assert response.status_code == 422
-    response_json = response.json()
-
-    assert response_json["detail"][0]["msg"] == "Field required"
 
+@pytest.fixture
+def uploaded_dataset(client, auth):
+    """Uploads a new file tagged "test" and returns the upload response."""
+    return upload_file(client, auth, unique_payload())
 
-@mock_s3
-def test_dataset_download_file():
-    api_key, secret = create_api_key("test_dataset_upload_file")
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
+def test_dataset_upload_file(uploaded_dataset):
+    # reading the object back is covered by test_dataset_download_file
+    assert uploaded_dataset["s3_object_name"]
 
-    test_file_contents = generate_random_bytes()
-    test_file = io.BytesIO(test_file_contents)
 
-    response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test"]},
-        auth=(api_key, secret),
-    )
+def test_dataset_download_file(client, auth):
+    api_key, secret = auth
 
-    assert response.status_code == 200
-    response_json = response.json()
+    test_file_contents = unique_payload()
 
-    assert response_json["status"] == "OK"
+    response_json = upload_file(client, auth, test_file_contents)
 
     dataset_object_id = response_json["dataset_object_id"]
 
     response = client.get(
         f"/dataset/{dataset_object_id}",
         auth=(api_key, secret),
+        follow_redirects=False,
     )
 
-    assert response.status_code == 200
-    assert response.content == test_file_contents
-
-
-@mock_s3
-def test_dataset_delete_file():
-    api_key, secret = create_api_key("test_dataset_upload_file")
+    assert response.status_code == 307
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
-
-    test_file_contents = generate_random_bytes()
-    test_file = io.BytesIO(test_file_contents)
-
-    response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test"]},
-        auth=(api_key, secret),
-    )
+    s3_response = requests.get(response.headers["location"])
 
-    assert response.status_code == 200
+    assert s3_response.status_code == 200
+    assert s3_response.content == test_file_contents
 
-    response_json = response.json()
 
-    assert response_json["status"] == "OK"
+def test_dataset_delete_file(client, auth, uploaded_dataset):
+    api_key, secret = auth
 
-    dataset_object_id = response_json["dataset_object_id"]
+    dataset_object_id = uploaded_dataset["dataset_object_id"]
 
     response = client.delete(
         f"/dataset/{dataset_object_id}",
@@ -160,27 +98,10 @@ def test_dataset_delete_file():
     assert response_json["detail"] == "File not found"
 
 
-@mock_s3
-def test_dataset_file_details():
-    api_key, secret = create_api_key("test_dataset_file_details")
-
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
-
-    test_file_contents = generate_random_bytes()
-    test_file = io.BytesIO(test_file_contents)
-
-    upload_response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test"]},
-        auth=(api_key, secret),
-    )
-
-    assert upload_response.status_code == 200
-    upload_response_json = upload_response.json()
+def test_dataset_file_details(client, auth):
+    api_key, secret = auth
 
-    assert upload_response_json["status"] == "OK"
+    upload_response_json = upload_file(client, auth, TEST_PAYLOAD)
     dataset_object_id = upload_response_json["dataset_object_id"]
 
     details_response = client.get(
@@ -194,11 +115,8 @@ def test_dataset_file_details():
     assert details_response_json["status"] == "OK"
     assert details_response_json["file"]["id"] == dataset_object_id
     assert details_response_json["file"]["name"] == "test_file.csv"
-    assert details_response_json["file"]["content_type"] == "application/vnd.ms-excel"
-    assert (
-        details_response_json["file"]["file_hash_sha1"]
-        == hashlib.sha1(test_file_contents).hexdigest()
-    )
+    assert details_response_json["file"]["content_type"] == "text/csv"
+    assert details_response_json["file"]["file_hash_sha1"] == EXPECTED_SHA1
     assert details_response_json["file"]["tags"][0]["tag"] == "test"
     assert (
         details_response_json["file"]["s3_object_name"]
@@ -207,28 +125,10 @@ def test_dataset_file_details():
     assert details_response_json["file"]["labels"] == []
 
 
-@mock_s3
-def test_dataset_file_add_tags():
-    api_key, secret = create_api_key("test_dataset_file_add_tags")
-
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
-
-    test_file_contents = generate_random_bytes()
-    test_file = io.BytesIO(test_file_contents)
+def test_dataset_file_add_tags(client, auth, uploaded_dataset):
+    api_key, secret = auth
 
-    upload_response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test"]},
-        auth=(api_key, secret),
-    )
-
-    assert upload_response.status_code == 200
-    upload_response_json = upload_response.json()
-
-    assert upload_response_json["status"] == "OK"
-    dataset_object_id = upload_response_json["dataset_object_id"]
+    dataset_object_id = uploaded_dataset["dataset_object_id"]
 
     add_tags_response = client.post(
         f"/dataset/{dataset_object_id}/tags",
@@ -263,27 +163,12 @@ def test_dataset_file_add_tags():
     assert duplicate_tags_response.json()["detail"] == "Tag already exists"
 
 
-@mock_s3
-def test_dataset_file_delete_tag():
-    api_key, secret = create_api_key("test_dataset_file_delete_tags")
+def test_dataset_file_delete_tag(client, auth):
+    api_key, secret = auth
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
-
-    test_file_contents = generate_random_bytes()
-    test_file = io.BytesIO(test_file_contents)
-
-    upload_response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test", "test tag"]},
-        auth=(api_key, secret),
+    upload_response_json = upload_file(
+        client, auth, unique_payload(), ["test", "test tag"]
     )
-
-    assert upload_response.status_code == 200
-    upload_response_json = upload_response.json()
-
-    assert upload_response_json["status"] == "OK"
     dataset_object_id = upload_response_json["dataset_object_id"]
 
     details_response = client.get(
@@ -317,39 +202,52 @@ def test_dataset_file_delete_tag():
     assert len(details_response_json["file"]["tags"]) == 1
 
 
-@mock_s3
-def test_dataset_file_add_label():
-    api_key, secret = create_api_key("test_dataset_file_add_label")
+def test_dataset_file_tags_not_found(client, auth, uploaded_dataset):
+    api_key, secret = auth
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
+    dataset_object_id = uploaded_dataset["dataset_object_id"]
 
-    test_file_contents = generate_random_bytes()
-    test_file = io.BytesIO(test_file_contents)
+    # the tag endpoints tell these apart by rowcount alone
+    add_tags_response = client.post(
+        f"/dataset/{uuid4()}/tags",
+        data={"tag": "test tag"},
+        auth=(api_key, secret),
+    )
 
-    upload_response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test"]},
+    assert add_tags_response.status_code == 404
+    assert add_tags_response.json()["detail"] == "File not found"
+
+    duplicate_tags_response = client.post(
+        f"/dataset/{dataset_object_id}/tags",
+        data={"tag": "test"},
         auth=(api_key, secret),
     )
 
-    assert upload_response.status_code == 200
-    upload_response_json = upload_response.json()
+    assert duplicate_tags_response.status_code == 400
+    assert duplicate_tags_response.json()["detail"] == "Tag already exists"
+
+    for file_guid in [dataset_object_id, uuid4()]:
+        delete_tags_response = client.delete(
+            f"/dataset/{file_guid}/tags/{uuid4()}",
+            auth=(api_key, secret),
+        )
+
+        assert delete_tags_response.status_code == 404
+        assert delete_tags_response.json()["detail"] == "Tag not found"
 
-    assert upload_response_json["status"] == "OK"
-    dataset_object_id = upload_response_json["dataset_object_id"]
+
+@pytest.fixture
+def labeled_file(client, auth, uploaded_dataset):
+    """Uploads a file and labels it, returning the file and label ids."""
+    api_key, secret = auth
+
+    dataset_object_id = uploaded_dataset["dataset_object_id"]
 
     add_label_response = client.post(
         f"/dataset/{dataset_object_id}/labels",
         data={
             "label": "test label",
-            "polygon": json.dumps(
-                [
-                    {"x": 0.1, "y": 0.1},
-                    {"x": 0.9, "y": 0.1},
-                ]
-            ),
+            "polygon": POLYGON_JSON,
         },
         auth=(api_key, secret),
     )
@@ -359,16 +257,14 @@ def test_dataset_file_add_label():
 
     assert add_label_response_json["status"] == "OK"
     assert add_label_response_json["label"]["label"] == "test label"
-    assert len(add_label_response_json["label"]["polygon"]) == 2
+    assert add_label_response_json["label"]["polygon"] == EXPECTED_POLYGON
 
-    assert add_label_response_json["label"]["polygon"][0] == {
-        "x": 0.1,
-        "y": 0.1,
-    }
-    assert add_label_response_json["label"]["polygon"][1] == {
-        "x": 0.9,
-        "y": 0.1,
-    }
+    return dataset_object_id, add_label_response_json["label"]["label_guid"]
+
+
+def test_dataset_file_add_label(client, auth, labeled_file):
+    api_key, secret = auth
+    dataset_object_id, label_guid = labeled_file
 
     details_response = client.get(
         f"/dataset/{dataset_object_id}/details",
@@ -380,17 +276,13 @@ def test_dataset_file_add_label():
 
     assert len(details_response_json["file"]["labels"]) == 1
     assert details_response_json["file"]["labels"][0]["label"] == "test label"
+    assert details_response_json["file"]["labels"][0]["label_guid"] == label_guid
 
     add_duplicate_label_response = client.post(
         f"/dataset/{dataset_object_id}/labels",
         data={
             "label": "test label",
-            "polygon": json.dumps(
-                [
-                    {"x": 0.1, "y": 0.1},
-                    {"x": 0.9, "y": 0.1},
-                ]
-            ),
+            "polygon": POLYGON_JSON,
         },
         auth=(api_key, secret),
     )
@@ -398,64 +290,85 @@ def test_dataset_file_add_label():
     assert add_duplicate_label_response.status_code == 400
 
 
-@mock_s3
-def test_dataset_file_delete_label():
-    api_key, secret = create_api_key("test_dataset_file_add_label")
-
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
+def test_dataset_file_add_label_polygon_validation(client, auth, uploaded_dataset):
+    api_key, secret = auth
 
-    test_file_contents = generate_random_bytes()
-    test_file = io.BytesIO(test_file_contents)
+    dataset_object_id = uploaded_dataset["dataset_object_id"]
 
-    upload_response = client.post(
-        "/dataset",
-        files={"file": ("test_file.csv", test_file)},
-        data={"tags": ["test"]},
+    add_label_response = client.post(
+        f"/dataset/{dataset_object_id}/labels",
+        data={
+            "label": "test label",
+            "polygon": orjson.dumps([{"left": 0.1, "top": 0.2}]).decode("utf8"),
+        },
         auth=(api_key, secret),
     )
 
-    assert upload_response.status_code == 200
-    upload_response_json = upload_response.json()
-
-    assert upload_response_json["status"] == "OK"
-    dataset_object_id = upload_response_json["dataset_object_id"]
+    assert add_label_response.status_code == 200
+    assert add_label_response.json()["label"]["polygon"] == [{"x": 0.1, "y": 0.2}]
 
-    add_label_response = client.post(
+    # aliases are stored as x/y, so the same polygon written either way is a duplicate
+    add_duplicate_label_response = client.post(
         f"/dataset/{dataset_object_id}/labels",
         data={
             "label": "test label",
-            "polygon": json.dumps(
+            "polygon": orjson.dumps([{"x": 0.1, "y": 0.2}]).decode("utf8"),
+        },
+        auth=(api_key, secret),
+    )
+
+    assert add_duplicate_label_response.status_code == 400
+    assert add_duplicate_label_response.json()["detail"] == "Label already exists"
+
+    for polygon in [
+        "not json",
+        orjson.dumps({"x": 0.1}).decode("utf8"),
+        orjson.dumps([{"x": 0.1}]).decode("utf8"),
+    ]:
+        add_label_response = client.post(
+            f"/dataset/{dataset_object_id}/labels",
+            data={
+                "label": "test label",
+                "polygon": polygon,
+            },
+            auth=(api_key, secret),
+        )
+
+        assert add_label_response.status_code == 400
+        assert add_label_response.json()["detail"] == "Invalid polygon"
+
+
+def test_dataset_file_add_annotations(client, auth, uploaded_dataset):
+    api_key, secret = auth
+
+    dataset_object_id = uploaded_dataset["dataset_object_id"]
+
+    add_annotations_response = client.post(
+        f"/dataset/{dataset_object_id}/annotations",
+        data={
+            "tags": ["test", "test tag"],
+            "labels": orjson.dumps(
                 [
-                    {
-                        "x": 0.1,
-                        "y": 0.1,
-                    },
-                    {
-                        "x": 0.9,
-                        "y": 0.1,
-                    },
+                    {"label": "test label", "polygon": EXPECTED_POLYGON},
+                    {"label": "other label", "polygon": [{"left": 0.1, "top": 0.2}]},
                 ]
-            ),
+            ).decode("utf8"),
         },
         auth=(api_key, secret),
     )
 
-    assert add_label_response.status_code == 200
-    add_label_response_json = add_label_response.json()
-
-    assert add_label_response_json["status"] == "OK"
-    assert add_label_response_json["label"]["label"] == "test label"
-    assert len(add_label_response_json["label"]["polygon"]) == 2
+    assert add_annotations_response.status_code == 200
+    add_annotations_response_json = add_annotations_response.json()
 
-    assert add_label_response_json["label"]["polygon"][0] == {
-        "x": 0.1,
-        "y": 0.1,
-    }
-    assert add_label_response_json["label"]["polygon"][1] == {
-        "x": 0.9,
-        "y": 0.1,
-    }
+    assert add_annotations_response_json["status"] == "OK"
+    # the file was uploaded with "test", so only the new tag is added
+    assert [tag["tag"] for tag in add_annotations_response_json["tags"]] == [
+        "test tag"
+    ]
+    assert add_annotations_response_json["labels"][0]["polygon"] == EXPECTED_POLYGON
+    assert add_annotations_response_json["labels"][1]["polygon"] == [
+        {"x": 0.1, "y": 0.2}
+    ]
 
     details_response = client.get(
         f"/dataset/{dataset_object_id}/details",
@@ -465,9 +378,53 @@ def test_dataset_file_delete_label():
     assert details_response.status_code == 200
     details_response_json = details_response.json()
 
-    assert len(details_response_json["file"]["labels"]) == 1
-    assert details_response_json["file"]["labels"][0]["label"] == "test label"
-    label_guid = details_response_json["file"]["labels"][0]["label_guid"]
+    assert len(details_response_json["file"]["tags"]) == 2
+    assert {label["label"] for label in details_response_json["file"]["labels"]} == {
+        "test label",
+        "other label",
+    }
+
+    # posting the same annotations again (re-running upload-to-api.py) adds nothing
+    repeat_annotations_response = client.post(
+        f"/dataset/{dataset_object_id}/annotations",
+        data={
+            "tags": ["test", "test tag"],
+            "labels": orjson.dumps(
+                [
+                    {"label": "test label", "polygon": EXPECTED_POLYGON},
+                    {"label": "other label", "polygon": [{"x": 0.1, "y": 0.2}]},
+                ]
+            ).decode("utf8"),
+        },
+        auth=(api_key, secret),
+    )
+
+    assert repeat_annotations_response.status_code == 200
+    assert repeat_annotations_response.json()["tags"] == []
+    assert repeat_annotations_response.json()["labels"] == []
+
+    details_response = client.get(
+        f"/dataset/{dataset_object_id}/details",
+        auth=(api_key, secret),
+    )
+
+    assert len(details_response.json()["file"]["labels"]) == 2
+
+    invalid_labels_response = client.post(
+        f"/dataset/{dataset_object_id}/annotations",
+        data={
+            "labels": orjson.dumps([{"label": "test label"}]).decode("utf8"),
+        },
+        auth=(api_key, secret),
+    )
+
+    assert invalid_labels_response.status_code == 400
+    assert invalid_labels_response.json()["detail"] == "Invalid labels"
+
+
+def test_dataset_file_delete_label(client, auth, labeled_file):
+    api_key, secret = auth
+    dataset_object_id, label_guid = labeled_file
 
     delete_label_response = client.delete(
         f"/dataset/{dataset_object_id}/labels/{label_guid}",
@@ -490,37 +447,119 @@ def test_dataset_file_delete_label():
     assert len(details_response_json["file"]["labels"]) == 0
 
 
-@mock_s3
-def test_dataset_list_files():
-    api_key, secret = create_api_key("test_list_files")
+def test_dataset_file_update_label(client, auth, labeled_file):
+    api_key, secret = auth
+    dataset_object_id, label_guid = labeled_file
+
+    updated_polygon = [{"x": 0.2, "y": 0.2}, {"x": 0.8, "y": 0.2}]
+
+    # sending the same values twice has to stay a 200, which relies on the driver
+    # reporting matched rather than changed rows
+    for _ in range(2):
+        update_label_response = client.put(
+            f"/dataset/{dataset_object_id}/labels/{label_guid}",
+            data={
+                "label": "updated label",
+                "polygon": orjson.dumps(updated_polygon).decode("utf8"),
+            },
+            auth=(api_key, secret),
+        )
+
+        assert update_label_response.status_code == 200
+        assert update_label_response.json()["status"] == "OK"
+
+    details_response = client.get(
+        f"/dataset/{dataset_object_id}/details",
+        auth=(api_key, secret),
+    )
+
+    assert details_response.status_code == 200
+    details_response_json = details_response.json()
+
+    assert details_response_json["file"]["labels"] == [
+        {
+            "label_guid": label_guid,
+            "label": "updated label",
+            "polygon": updated_polygon,
+        }
+    ]
+
+    invalid_polygon_response = client.put(
+        f"/dataset/{dataset_object_id}/labels/{label_guid}",
+        data={"label": "updated label", "polygon": "not json"},
+        auth=(api_key, secret),
+    )
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["DATASET_S3_BUCKET"])
+    assert invalid_polygon_response.status_code == 400
+    assert invalid_polygon_response.json()["detail"] == "Invalid polygon"
+
+    for file_guid, missing_label_guid in [
+        (dataset_object_id, uuid4()),
+        (uuid4(), label_guid),
+    ]:
+        update_label_response = client.put(
+            f"/dataset/{file_guid}/labels/{missing_label_guid}",
+            data={"label": "updated label", "polygon": POLYGON_JSON},
+            auth=(api_key, secret),
+        )
+
+        assert update_label_response.status_code == 404
+        assert update_label_response.json()["detail"] == "Label not found"
+
+
+def test_dataset_file_delete_label_not_found(client, auth, labeled_file):
+    api_key, secret = auth
+    dataset_object_id, label_guid = labeled_file
+
+    for file_guid, missing_label_guid in [
+        (dataset_object_id, uuid4()),
+        (uuid4(), label_guid),
+    ]:
+        delete_label_response = client.delete(
+            f"/dataset/{file_guid}/labels/{missing_label_guid}",
+            auth=(api_key, secret),
+        )
+
+        assert delete_label_response.status_code == 404
+        assert delete_label_response.json()["detail"] == "Label not found"
+
+
+def test_dataset_list_files(client, auth, upload_many):
+    api_key, secret = auth
+
+    # other tests share the database, so count from what is already there and
+    # search on a tag only this run uses
+    response = client.get(
+        "/dataset",
+        auth=(api_key, secret),
+    )
+
+    assert response.status_code == 200
+    initial_count = response.json()["total_count"]
+
+    list_tag = f"list-{uuid4()}"
 
     random_file_count = random.randint(10, 99)
     test_tag_file_count = 0
 
-    for i in range(random_file_count):
-        test_file_contents = generate_random_bytes()
-        test_file = io.BytesIO(test_file_contents)
+    uploads = []
 
-        tag = "test" if i % 2 == 0 else "not_test"
+    for i in range(random_file_count):
+        tag = list_tag if i % 2 == 0 else "not_test"
 
-        if tag == "test":
+        if tag == list_tag:
             test_tag_file_count += 1
 
-        upload_response = client.post(
-            "/dataset",
-            files={"file": (f"test_file_{i}.csv", test_file)},
-            data={"tags": [tag]},
-            auth=(api_key, secret),
-        )
+        uploads.append((f"test_file_{i}.csv", unique_payload(), [tag]))
 
+    for upload_response in upload_many(uploads):
         assert upload_response.status_code == 200
         upload_response_json = upload_response.json()
 
         assert upload_response_json["status"] == "OK"
 
+    total_count = initial_count + random_file_count
+
     response = client.get(
         "/dataset",
         auth=(api_key, secret),
@@ -531,11 +570,11 @@ def test_dataset_list_files():
 
     assert response_json["status"] == "OK"
     assert len(response_json["files"]) == response_json["count"]
-    assert response_json["total_count"] == random_file_count
+    assert response_json["total_count"] == total_count
 
     response = client.get(
         "/dataset",
-        params={"search_tags": "test", "limit": 100, "offset": 0},
+        params={"search_tags": list_tag, "limit": 100, "offset": 0},
         auth=(api_key, secret),
     )
 
@@ -545,7 +584,7 @@ def test_dataset_list_files():
     assert response_json["status"] == "OK"
     assert len(response_json["files"]) == test_tag_file_count
     assert response_json["count"] == test_tag_file_count
-    assert response_json["total_count"] == random_file_count
+    assert response_json["total_count"] == total_count
 
     response = client.get(
         "/dataset",
@@ -559,4 +598,4 @@ def test_dataset_list_files():
     assert response_json["status"] == "OK"
     assert len(response_json["files"]) == 5
     assert response_json["count"] == 5
-    assert response_json["total_count"] == random_file_count
+    assert response_json["total_count"] == total_count
@@ -1,11 +1,66 @@
+import pytest
+
 from fastapi.testclient import TestClient
 
+from .conftest import TEST_PAYLOAD
 from .main import app
 
-client = TestClient(app)
-
 
-def test_index():
+def test_index(client):
     response = client.get("/")
     assert response.status_code == 200
     assert response.json() == {"status": "OK"}
+
+
+def test_login_session_cookie(client, auth):
+    api_key, secret = auth
+
+    response = client.post("/login", auth=("invalid", "invalid"))
+    assert response.status_code == 401
+
+    # a separate client so the cookie jar doesn't leak into other tests
+    with TestClient(app) as session_client:
+        response = session_client.post("/")
+        assert response.status_code == 401
+
+        response = session_client.post("/login", auth=(api_key, secret))
+        assert response.status_code == 200
+        assert "session" in response.cookies
+        assert "samesite=strict" in response.headers["set-cookie"].lower()
+
+        response = session_client.post("/")
+        assert response.status_code == 200
+        assert response.json() == {"status": "OK"}
+
+        session_client.cookies.set("session", "tampered")
+
+        response = session_client.post("/")
+        assert response.status_code == 401
+
+
+@pytest.mark.parametrize("endpoint", ["/dataset", "/models"])
+def test_upload_file_no_auth(client, endpoint):
+    response = client.post(
+        endpoint,
+        files={"file": ("test_file.csv", TEST_PAYLOAD)},
+    )
+
+    assert response.status_code == 401
+    response_json = response.json()
+
+    assert response_json["detail"] == "Not authenticated"
+
+
+@pytest.mark.parametrize("endpoint", ["/dataset", "/models"])
+def test_upload_file_no_file(client, auth, endpoint):
+    api_key, secret = auth
+
+    response = client.post(
+        endpoint,
+        auth=(api_key, secret),
+    )
+
+    assert response.status_code == 422
+    response_json = response.json()
+
+    assert response_json["detail"][0]["msg"] == "Field required"
@@ -1,29 +1,16 @@
-import boto3
-import io
-import os
+import requests
 
+from uuid import uuid4
 
-from fastapi.testclient import TestClient
-from moto import mock_s3
+from .conftest import TEST_PAYLOAD
 
-from .main import app
-from .db.commands.create_api_key import create_api_key
 
-client = TestClient(app)
-
-
-@mock_s3
-def test_model_upload_file():
-    api_key, secret = create_api_key("test_model_upload_file")
-
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["MLMODEL_S3_BUCKET"])
-
-    file_contents = io.BytesIO(b"some test data")
+def test_model_upload_file(client, auth):
+    api_key, secret = auth
 
     response = client.post(
         "/models",
-        files={"file": ("test_file.csv", file_contents)},
+        files={"file": ("test_file.csv", TEST_PAYLOAD)},
         data={"tags": ["test"]},
         auth=(api_key, secret),
     )
@@ -33,57 +20,46 @@ def test_model_upload_file():
 
     assert response_json["status"] == "OK"
 
-    s3_object_name = response_json["s3_object_name"]
+    # reading the object back is covered by test_model_download_file
+    assert response_json["s3_object_name"]
 
-    s3_object = s3_client.get_object(
-        Bucket=os.environ["MLMODEL_S3_BUCKET"],
-        Key=s3_object_name,
-    )
-
-    assert s3_object["Body"].read() == b"some test data"
 
+def test_model_download_file(client, auth):
+    api_key, secret = auth
 
-@mock_s3
-def test_model_upload_file_no_auth():
     response = client.post(
         "/models",
-        files={"file": ("test_file.csv", b"some test data")},
+        files={"file": ("test_file.csv", TEST_PAYLOAD)},
+        data={"tags": ["test"]},
+        auth=(api_key, secret),
     )
 
-    assert response.status_code == 401
+    assert response.status_code == 200
     response_json = response.json()
 
-    assert response_json["detail"] == "Not authenticated"
-
+    assert response_json["status"] == "OK"
 
-@mock_s3
-def test_model_upload_file_no_file():
-    api_key, secret = create_api_key("test_model_upload_file")
+    model_object_id = response_json["model_object_id"]
 
-    response = client.post(
-        "/models",
+    response = client.get(
+        f"/models/{model_object_id}",
         auth=(api_key, secret),
+        follow_redirects=False,
     )
 
-    assert response.status_code == 422
-    response_json = response.json()
+    assert response.status_code == 307
 
-    assert response_json["detail"][0]["msg"] == "Field required"
+    s3_response = requests.get(response.headers["location"])
 
+    assert s3_response.status_code == 200
+    assert s3_response.content == TEST_PAYLOAD
 
-@mock_s3
-def test_model_download_file():
-    api_key, secret = create_api_key("test_model_upload_file")
 
-    s3_client = boto3.client("s3", region_name="us-east-1")
-    s3_client.create_bucket(Bucket=os.environ["MLMODEL_S3_BUCKET"])
+def test_model_list_files(client, auth):
+    api_key, secret = auth
 
-    file_contents = io.BytesIO(b"some test data")
-
-    response = client.post(
+    response = client.get(
         "/models",
-        files={"file": ("test_file.csv", file_contents)},
-        data={"tags": ["test"]},
         auth=(api_key, secret),
     )
 
@@ -91,41 +67,65 @@ def test_model_download_file():
     response_json = response.json()
 
     assert response_json["status"] == "OK"
-
-    model_object_id = response_json["model_object_id"]
+    assert len(response_json["files"]) == response_json["count"]
 
     response = client.get(
-        f"/models/{model_object_id}",
+        "/models",
+        params={"tags": ["test"]},
         auth=(api_key, secret),
     )
 
     assert response.status_code == 200
-    assert response.content == b"some test data"
+    response_json = response.json()
 
+    assert response_json["status"] == "OK"
+    assert len(response_json["files"]) == response_json["count"]
 
-@mock_s3
-def test_model_list_files():
-    api_key, secret = create_api_key("test_list_files")
 
-    response = client.get(
+def test_model_file_tags(client, auth):
+    api_key, secret = auth
+
+    response = client.post(
         "/models",
+        files={"file": ("test_file.csv", TEST_PAYLOAD)},
+        data={"tags": ["test"]},
         auth=(api_key, secret),
     )
 
     assert response.status_code == 200
-    response_json = response.json()
+    model_object_id = response.json()["model_object_id"]
 
-    assert response_json["status"] == "OK"
-    assert len(response_json["files"]) == response_json["count"]
+    add_tag_response = client.post(
+        f"/models/{model_object_id}/tags",
+        data={"tag": "test tag"},
+        auth=(api_key, secret),
+    )
 
-    response = client.get(
-        "/models",
-        params={"tags": ["test"]},
+    assert add_tag_response.status_code == 200
+    tag_guid = add_tag_response.json()["tag"]["tag_guid"]
+
+    # the tag endpoints tell these apart by rowcount alone
+    add_tag_response = client.post(
+        f"/models/{uuid4()}/tags",
+        data={"tag": "test tag"},
         auth=(api_key, secret),
     )
 
-    assert response.status_code == 200
-    response_json = response.json()
+    assert add_tag_response.status_code == 404
+    assert add_tag_response.json()["detail"] == "File not found"
 
-    assert response_json["status"] == "OK"
-    assert len(response_json["files"]) == response_json["count"]
+    delete_tag_response = client.delete(
+        f"/models/{model_object_id}/tags/{tag_guid}",
+        auth=(api_key, secret),
+    )
+
+    assert delete_tag_response.status_code == 200
+
+    for file_guid in [model_object_id, uuid4()]:
+        delete_tag_response = client.delete(
+            f"/models/{file_guid}/tags/{tag_guid}",
+            auth=(api_key, secret),
+        )
+
+        assert delete_tag_response.status_code == 404
+        assert delete_tag_response.json()["detail"] == "Tag not found"
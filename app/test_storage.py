@@ -0,0 +1,56 @@
+import io
+import os
+
+
+from . import storage
+
+DATASET_BUCKET = os.environ["DATASET_S3_BUCKET"]
+
+
+def test_upload_file_single_part(s3_client):
+    test_file_contents = os.urandom(64)
+
+    storage.upload_file(
+        s3_client,
+        io.BytesIO(test_file_contents),
+        DATASET_BUCKET,
+        "test_upload_file_single_part",
+        content_type="text/csv",
+    )
+
+    s3_object = s3_client.get_object(
+        Bucket=DATASET_BUCKET,
+        Key="test_upload_file_single_part",
+    )
+
+    assert s3_object["Body"].read() == test_file_contents
+    assert s3_object["ContentType"] == "text/csv"
+
+
+def test_upload_file_multipart(monkeypatch, s3_client):
+    # the smallest part size S3 accepts, so the test doesn't need 64 MiB files
+    monkeypatch.setattr(storage, "UPLOAD_PART_SIZE", 5 * 1024 * 1024)
+
+    test_file_contents = os.urandom(11 * 1024 * 1024)
+
+    storage.upload_file(
+        s3_client,
+        io.BytesIO(test_file_contents),
+        DATASET_BUCKET,
+        "test_upload_file_multipart",
+    )
+
+    s3_object = s3_client.get_object(
+        Bucket=DATASET_BUCKET,
+        Key="test_upload_file_multipart",
+    )
+
+    assert s3_object["Body"].read() == test_file_contents
+    assert s3_object["ETag"].endswith('-3"')
+
+
+def test_guess_content_type():
+    assert storage.guess_content_type("image.JPG") == "image/jpeg"
+    assert storage.guess_content_type("annotations.xml") == "application/xml"
+    assert storage.guess_content_type("notes.txt", "text/plain") == "text/plain"
+    assert storage.guess_content_type("no_extension") == "application/octet-stream"
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import AliasChoices, BaseModel, Field
 from uuid import UUID
 
 import datetime
@@ -9,8 +9,9 @@ class BasicResponse(BaseModel):
 
 
 class Point(BaseModel):
-    x: float
-    y: float
+    # annotation tools send left/top, which are accepted as x/y
+    x: float = Field(validation_alias=AliasChoices("x", "left"))
+    y: float = Field(validation_alias=AliasChoices("y", "top"))
 
 
 class Label(BaseModel):
@@ -19,6 +20,11 @@ class Label(BaseModel):
     polygon: list[Point]
 
 
+class NewLabel(BaseModel):
+    label: str
+    polygon: list[Point]
+
+
 class Node(BaseModel):
     left: float
     top: float
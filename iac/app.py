@@ -3,16 +3,28 @@ import os
 
 import aws_cdk as cdk
 
-from iac.iac_stack import IacStack
+from iac.certificate_stack import CertificateStack
+from iac.data_stack import DataStack
+from iac.service_stack import ServiceStack
 
 
 app = cdk.App()
 
-IacStack(
+# every stack needs the explicit environment so the hosted zone lookup works
+# For more information, see https://docs.aws.amazon.com/cdk/latest/guide/environments.html
+env = cdk.Environment(account="533266972570", region="us-east-2")
+
+# the stateful resources keep the original stack id so the deployed ones are updated in
+# place (see README); the certificate has no dependencies and validates in parallel
+data = DataStack(app, "IacStack", env=env)
+certificate = CertificateStack(app, "CertificateStack", env=env)
+
+ServiceStack(
     app,
-    "IacStack",
-    env=cdk.Environment(account="533266972570", region="us-east-2"),
-    # For more information, see https://docs.aws.amazon.com/cdk/latest/guide/environments.html
+    "ServiceStack",
+    data=data,
+    certificate=certificate,
+    env=env,
 )
 
 app.synth()
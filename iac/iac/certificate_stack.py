@@ -0,0 +1,23 @@
+from aws_cdk import (
+    Stack,
+    aws_certificatemanager as acm,
+    aws_route53 as route53,
+)
+from constructs import Construct
+
+
+class CertificateStack(Stack):
+    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        self.hosted_zone = route53.HostedZone.from_lookup(
+            self, "tubesml-hosted-zone", domain_name="tsi-mlops.com"
+        )
+
+        self.certificate = acm.Certificate(
+            self,
+            "tubesml-certificate",
+            domain_name="tsi-mlops.com",
+            subject_alternative_names=["*.tsi-mlops.com"],
+            validation=acm.CertificateValidation.from_dns(self.hosted_zone),
+        )
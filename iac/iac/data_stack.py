@@ -0,0 +1,143 @@
+from aws_cdk import (
+    Stack,
+    aws_ec2 as ec2,
+    aws_ecr as ecr,
+    aws_rds as rds,
+    aws_s3 as s3,
+    aws_secretsmanager as secretsmanager,
+)
+import aws_cdk as cdk
+from constructs import Construct
+
+
+class DataStack(Stack):
+    """The VPC and every stateful resource. Deployed under the original IacStack id with
+    the original construct ids, so the live database, buckets, secrets and repository
+    keep their CloudFormation logical ids and are updated in place, not recreated.
+    """
+
+    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        #
+        # Networking
+        #
+
+        # VPC, kept next to the database since replacing it would replace the database
+        self.vpc = ec2.Vpc(
+            self,
+            "tubesml",
+            ip_addresses=ec2.IpAddresses.cidr("10.10.0.0/16"),
+            max_azs=2,
+            create_internet_gateway=True,
+            subnet_configuration=[
+                ec2.SubnetConfiguration(
+                    name="public", subnet_type=ec2.SubnetType.PUBLIC
+                )
+            ],
+            enable_dns_hostnames=True,
+            enable_dns_support=True,
+            # route S3 traffic through the VPC instead of out the internet gateway
+            gateway_endpoints={
+                "S3": ec2.GatewayVpcEndpointOptions(
+                    service=ec2.GatewayVpcEndpointAwsService.S3
+                )
+            },
+        )
+
+        self.db_credentials_secret = secretsmanager.Secret(
+            self,
+            "tubesml-db-credentials-secret",
+            secret_name="tubesml-db-credentials",
+            generate_secret_string=secretsmanager.SecretStringGenerator(
+                exclude_punctuation=True,
+                include_space=False,
+                password_length=20,
+                secret_string_template='{"username": "tubesml"}',
+                generate_string_key="password",
+            ),
+        )
+
+        self.app_secret = secretsmanager.Secret(
+            self,
+            "tube-ml-app-secret",
+            secret_name="tube-ml-app-secret",
+            generate_secret_string=secretsmanager.SecretStringGenerator(
+                exclude_punctuation=True,
+                include_space=False,
+                password_length=36,
+                secret_string_template="{}",
+                generate_string_key="secret",
+            ),
+        )
+
+        db_creds = rds.Credentials.from_secret(
+            secret=self.db_credentials_secret,
+            username="tubesml",
+        )
+
+        self.database = rds.DatabaseInstance(
+            self,
+            "tubesml-db",
+            database_name="tubesml",
+            instance_identifier="tubesml",
+            credentials=db_creds,
+            engine=rds.DatabaseInstanceEngine.maria_db(
+                version=rds.MariaDbEngineVersion.VER_10_11_6
+            ),
+            # Graviton burstable, more baseline throughput than t3 for the same price
+            instance_type=ec2.InstanceType.of(
+                ec2.InstanceClass.BURSTABLE4_GRAVITON, ec2.InstanceSize.MICRO
+            ),
+            allocated_storage=100,
+            vpc=self.vpc,
+            vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PUBLIC),
+            port=3306,
+            deletion_protection=False,
+            publicly_accessible=True,
+            allow_major_version_upgrade=True,
+        )
+
+        self.database.connections.allow_default_port_internally()
+        self.database.connections.allow_default_port_from(
+            ec2.Peer.ipv4("170.62.7.110/32"),
+            description="Allow access to the database from Seths home IP",
+        )  # Seth's Computer
+
+        #
+        # Image Storage
+        #
+
+        # the API aborts multipart uploads that fail, but parts from a task that dies
+        # mid-upload would otherwise be stored (and billed) forever
+        abort_incomplete_uploads = s3.LifecycleRule(
+            abort_incomplete_multipart_upload_after=cdk.Duration.days(7),
+        )
+
+        # ECR Repository for API container
+        self.ecr_repository = ecr.Repository(
+            self,
+            "tubesml-api",
+            repository_name="tubesml-api",
+            image_scan_on_push=True,
+        )
+
+        # S3 Bucket for dataset storage
+        self.dataset_bucket = s3.Bucket(
+            self,
+            "tubesml-dataset-bucket",
+            bucket_name="tubesml-dataset",
+            public_read_access=False,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+            lifecycle_rules=[abort_incomplete_uploads],
+        )
+
+        # S3 Bucket for dataset storage
+        self.model_bucket = s3.Bucket(
+            self,
+            "tubesml-model-bucket",
+            bucket_name="tubesml-model",
+            public_read_access=False,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+            lifecycle_rules=[abort_incomplete_uploads],
+        )
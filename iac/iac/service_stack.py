@@ -0,0 +1,117 @@
+from aws_cdk import (
+    Stack,
+    aws_ecs as ecs,
+    aws_ecs_patterns as ecs_patterns,
+    aws_iam as iam,
+)
+from constructs import Construct
+
+from .certificate_stack import CertificateStack
+from .data_stack import DataStack
+
+
+class ServiceStack(Stack):
+    def __init__(
+        self,
+        scope: Construct,
+        construct_id: str,
+        data: DataStack,
+        certificate: CertificateStack,
+        **kwargs
+    ) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        #
+        # Compute
+        #
+
+        # ECS Cluster
+        cluster = ecs.Cluster(
+            self,
+            "tubesml-api-cluster",
+            cluster_name="tubesml-api",
+            vpc=data.vpc,
+        )
+
+        ecs_service = ecs_patterns.ApplicationLoadBalancedFargateService(
+            self,
+            "tubesml-api-service",
+            assign_public_ip=True,
+            cluster=cluster,
+            cpu=1024,
+            certificate=certificate.certificate,
+            desired_count=1,
+            domain_name="api.tsi-mlops.com",
+            domain_zone=certificate.hosted_zone,
+            listener_port=443,
+            # load_balancer_name="tubesml-api-lb",
+            memory_limit_mib=8192,  # Default is 512
+            public_load_balancer=True,
+            redirect_http=True,
+            # Graviton tasks; the image must be built for linux/arm64 (see README)
+            runtime_platform=ecs.RuntimePlatform(
+                cpu_architecture=ecs.CpuArchitecture.ARM64,
+                operating_system_family=ecs.OperatingSystemFamily.LINUX,
+            ),
+            service_name="tubesml-api",
+            task_image_options=ecs_patterns.ApplicationLoadBalancedTaskImageOptions(
+                image=ecs.ContainerImage.from_ecr_repository(
+                    repository=data.ecr_repository,
+                    # deploy a pushed git sha with `cdk deploy -c image_tag=<sha>` so the
+                    # task definition only changes when the image does
+                    tag=self.node.try_get_context("image_tag") or "latest",
+                ),
+                container_port=8000,
+                container_name="web",
+                family="tubesml-api",
+                secrets={
+                    "DB_PASSWORD": ecs.Secret.from_secrets_manager(
+                        data.db_credentials_secret, field="password"
+                    ),
+                    "SECRET_KEY": ecs.Secret.from_secrets_manager(
+                        data.app_secret, field="secret"
+                    ),
+                },
+                environment={
+                    "DB_HOST": data.database.db_instance_endpoint_address,
+                    "DB_PORT": data.database.db_instance_endpoint_port,
+                    "DB_USER": "tubesml",
+                    "DB_NAME": "tubesml",
+                    "DATASET_S3_BUCKET": data.dataset_bucket.bucket_name,
+                    "MLMODEL_S3_BUCKET": data.model_bucket.bucket_name,
+                },
+            ),
+        )
+
+        # declared from the service side so the ingress rule lives in this stack
+        # instead of making DataStack depend back on ServiceStack
+        ecs_service.service.connections.allow_to_default_port(
+            data.database, description="Allow access to the database from the API"
+        )
+
+        # one statement covering both buckets instead of a grant_read_write per
+        # bucket and role, the same actions grant_read_write would allow
+        bucket_read_write = iam.PolicyStatement(
+            actions=[
+                "s3:GetObject*",
+                "s3:GetBucket*",
+                "s3:List*",
+                "s3:DeleteObject*",
+                "s3:PutObject",
+                "s3:PutObjectLegalHold",
+                "s3:PutObjectRetention",
+                "s3:PutObjectTagging",
+                "s3:PutObjectVersionTagging",
+                "s3:Abort*",
+            ],
+            resources=[
+                data.dataset_bucket.bucket_arn,
+                data.dataset_bucket.arn_for_objects("*"),
+                data.model_bucket.bucket_arn,
+                data.model_bucket.arn_for_objects("*"),
+            ],
+        )
+
+        # only the running app touches the buckets; the execution role just pulls the
+        # image and reads the secrets, which CDK already grants it
+        ecs_service.task_definition.task_role.add_to_principal_policy(bucket_read_write)
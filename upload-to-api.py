@@ -2,20 +2,25 @@
 using this to upload images to endpoint
 """
 
+import asyncio
 import json
 import os
 
 # import matplotlib.pyplot as plt
 from PIL import Image
-import xml.etree.ElementTree as ET
+
+# lxml parses with libxml2 and is several times faster, ElementTree works the same way
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
 import numpy as np
 import pandas as pd
-from hashlib import md5
+import hashlib
 import mimetypes
 import httpx
 
-mimetypes.init()
-
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -24,21 +29,37 @@ API_ROOT = os.environ["API_ROOT"]
 API_KEY = os.environ["API_KEY"]
 API_SECRET = os.environ["API_SECRET"]
 
+# images in flight at once; each is one upload plus one request for its labels
+UPLOAD_CONCURRENCY = 32
+
+# the dataset is all BMPs, so skip loading the system mime.types database for them
+BMP_MIMETYPE = "image/bmp"
+
+# sha1s of every file already in the dataset, kept between runs so a rerun doesn't
+# have to list the whole dataset before it starts
+UPLOADED_CACHE_PATH = ".uploaded.json"
+
 """useful functions"""
 
 
 def read_xml(xml_path):
     """Reads the XML file and extracts bounding box coordinates for all defects."""
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
     defects = []
-    for obj in root.findall("object"):
-        name = obj.find("name").text
-        xmin = int(obj.find("bndbox/xmin").text)
-        ymin = int(obj.find("bndbox/ymin").text)
-        xmax = int(obj.find("bndbox/xmax").text)
-        ymax = int(obj.find("bndbox/ymax").text)
+
+    # stream the objects instead of building the whole tree first
+    for _, obj in ET.iterparse(xml_path):
+        if obj.tag != "object":
+            continue
+
+        name = obj.findtext("name")
+        xmin = int(obj.findtext("bndbox/xmin"))
+        ymin = int(obj.findtext("bndbox/ymin"))
+        xmax = int(obj.findtext("bndbox/xmax"))
+        ymax = int(obj.findtext("bndbox/ymax"))
         defects.append((name, xmin, ymin, xmax, ymax))
+
+        obj.clear()
+
     return defects
 
 
@@ -66,56 +87,71 @@ def read_xml(xml_path):
 #     plt.show()
 
 
-def grab_defect_data(image_path, xml_path):
-    """grabs bounding boxes info for all defects on the image for associated xml file."""
+def grab_defect_data(image_path, xml_path, image_file=None):
+    """grabs bounding boxes info for all defects on the image for associated xml file.
+    image_file is an already open handle on the image, to read it from instead of
+    opening the file again."""
 
-    defect_list = []
-    image = Image.open(image_path)
-    defects = read_xml(xml_path)
+    # PIL only parses the header until pixels are asked for, so this skips the decode
+    with Image.open(image_file or image_path) as image:
+        w, h = image.size
+        c = len(image.getbands())
 
-    h, w, c = np.shape(image)
+    defects = read_xml(xml_path)
 
-    for name, xmin, ymin, xmax, ymax in defects:
+    names = [name for name, *_ in defects]
 
-        xmin_n = xmin / w
-        xmax_n = xmax / w
-        ymin_n = ymin / h
-        ymax_n = ymax / h
+    # normalize every box in one array op instead of four divisions per defect
+    boxes = np.array([box for _, *box in defects], dtype=np.float64).reshape(-1, 4)
+    boxes /= np.array([w, h, w, h], dtype=np.float64)
 
-        img_name = os.path.basename(image_path).split("/")[-1]
-        defect_list.append([img_name, h, w, c, name, xmin_n, ymin_n, xmax_n, ymax_n])
+    img_name = os.path.basename(image_path).split("/")[-1]
 
     df = pd.DataFrame(
-        data=defect_list,
-        columns=[
-            "image_path",
-            "h",
-            "w",
-            "c",
-            "defect",
-            "xmin_n",
-            "ymin_n",
-            "xmax_n",
-            "ymax_n",
-        ],
+        {
+            "image_path": img_name,
+            "h": h,
+            "w": w,
+            "c": c,
+            "defect": names,
+            "xmin_n": boxes[:, 0],
+            "ymin_n": boxes[:, 1],
+            "xmax_n": boxes[:, 2],
+            "ymax_n": boxes[:, 3],
+        },
     )
     return df
 
+
+def file_sha1(file_stream, bufsize=1 << 20):
+    """sha1 of a file read in chunks, so large images are never held in memory whole.
+    sha1 because that's the hash the API stores and deduplicates on."""
+    if hasattr(hashlib, "file_digest"):
+        # python 3.11+, reads into one reusable buffer instead of a bytes per chunk
+        return hashlib.file_digest(file_stream, "sha1").hexdigest()
+
+    file_hash = hashlib.sha1()
+
+    for chunk in iter(lambda: file_stream.read(bufsize), b""):
+        file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
 def delete_data_object(file_guid):
     list_response = httpx.delete(
         f"{API_ROOT}/dataset/{file_guid}",
-        auth=(os.environ["API_KEY"], os.environ["API_SECRET"]),
+        auth=(API_KEY, API_SECRET),
     )
 
     json_response = list_response.json()
     return json_response
     
-def upload_to_api(file_name, file_stream, file_mimetype):
-    file_details_response = httpx.post(
+async def upload_to_api(client, file_name, file_stream, file_mimetype, tags=()):
+    file_details_response = await client.post(
         f"{API_ROOT}/dataset",
         files={"file": (file_name, file_stream, file_mimetype)},
-        auth=(API_KEY, API_SECRET),
-        timeout=600.0,
+        data={"tags": list(tags)},
     )
 
     file_details = file_details_response.json()
@@ -134,130 +170,193 @@ def upload_to_api(file_name, file_stream, file_mimetype):
 def get_uploaded_files():
     list_response = httpx.get(
         f"{API_ROOT}/dataset",
-        auth=(os.environ["API_KEY"], os.environ["API_SECRET"]),
+        auth=(API_KEY, API_SECRET),
+        timeout=600.0,
     )
 
     json_response = list_response.json()
     return json_response["files"]
 
 
-def upload_tag_to_api(file_guid, tag):
-    """send tag to endpoint. Tag must be string"""
+async def send_labels_to_api(client, file_guid, labels):
+    """send every label of a file to the api in one request. labels is a list of
+    {"label": ..., "polygon": [...]} dicts"""
 
-    tag_details_response = httpx.post(
-        f"{API_ROOT}/dataset/{file_guid}/tags",
-        data={"tag": tag},
-        auth=(API_KEY, API_SECRET),
-        timeout=600.0,
+    labels_response = await client.post(
+        f"{API_ROOT}/dataset/{file_guid}/annotations",
+        data={"labels": json.dumps(labels)},
     )
 
-    if tag_details_response.status_code != 200:
-        print("Something happened", tag_details_response.status_code)
+    if labels_response.status_code != 200:
+        print("Something happened", labels_response.status_code)
 
-    out = tag_details_response.json()
+    print("send labels to api: ", labels_response.json())
 
-    print("tag response: ", out)
 
+def load_uploaded_hashes():
+    """sha1s of files already uploaded, from the local cache or else from the API"""
 
-def send_label_to_api(file_guid, label, defect_response):
-    """send polygon data to api"""
+    if os.path.exists(UPLOADED_CACHE_PATH):
+        with open(UPLOADED_CACHE_PATH) as f:
+            return set(json.load(f))
 
-    label_details_response = httpx.post(
-        f"{API_ROOT}/dataset/{file_guid}/labels",
-        data={"label": label, "polygon": json.dumps(defect_response)},
-        auth=(API_KEY, API_SECRET),
-        timeout=600.0,
-    )
+    return {file["file_hash_sha1"] for file in get_uploaded_files()}
 
-    if label_details_response.status_code != 200:
-        print("Something happened", label_details_response.status_code)
 
-    label_details_response = label_details_response.json()
+def save_uploaded_hashes(uploaded):
+    with open(UPLOADED_CACHE_PATH, "w") as f:
+        json.dump(sorted(uploaded), f)
 
-    print("send label to api: ", label_details_response)
 
+async def process_image(client, semaphore, uploaded, image_path, xml_path):
+    """uploads one image with its tag and labels, returns its defects or None when it
+    was skipped or failed. uploaded images are added to uploaded as they finish"""
 
-def main():
-    image_cache = []
+    async with semaphore:
+        # # --- add image to API here -----
+        with open(image_path, "rb") as f:
+            # hashing and parsing block, so they run on worker threads and the event
+            # loop keeps the other images' requests moving meanwhile
+            file_hash = await asyncio.to_thread(file_sha1, f)
 
-    # combined_folder = r"C:\Users\endle\Desktop\object-detection-pytorch-wandb-coco\data\combined"
-    # combined_folder = r"C:\Users\Administrator\Desktop\defect-detection\TSI  -object-detection-pytorch-wandb-coco\data\combined"
-    combined_folder = r"C:\Users\sblac\Programming\tubes\object-detection-pytorch-wandb-coco\data\train2017"
-    df_f = pd.DataFrame(
-        columns=[
-            "image_path",
-            "h",
-            "w",
-            "c",
-            "defect",
-            "xmin_n",
-            "ymin_n",
-            "xmax_n",
-            "ymax_n",
-        ]
-    )
+            if file_hash in uploaded:
+                print(f"Skipping {image_path}: already uploaded")
+                return None
 
-    for filename in os.listdir(combined_folder):
-        print(filename)
+            # plot your defects on images here, double check overlay..its good.
+            # plot_defects_on_image(image_path, xml_path)
 
-        if filename.endswith(".bmp"):
-            image_path = os.path.join(combined_folder, filename)
-            xml_path = os.path.join(combined_folder, filename.replace(".bmp", ".xml"))
+            # defects stored as dataframe here, the header is read from the handle
+            # that was just hashed so the image is only opened once
+            f.seek(0)
+            df = await asyncio.to_thread(grab_defect_data, image_path, xml_path, f)
 
-            if os.path.exists(xml_path):  # Check if the associated .xml file exists
+            # rewind so the upload streams the whole file, not an exhausted handle
+            f.seek(0)
 
-                # plot your defects on images here, double check overlay..its good.
-                # plot_defects_on_image(image_path, xml_path)
+            if image_path.endswith(".bmp"):
+                file_mimetype = BMP_MIMETYPE
+            else:
+                file_mimetype = mimetypes.guess_type(image_path)[0]
+            print(f"File mimetype: {file_mimetype}")
 
-                # defects stored as dataframe here
-                df = grab_defect_data(image_path, xml_path)
+            # the tag goes with the upload rather than in a request of its own
+            file_guid = await upload_to_api(
+                client, image_path, f, file_mimetype, tags=["RetinaNet-POC"]
+            )
 
-                # # --- add image to API here -----
-                with open(image_path, "rb") as f:
-                    file_hash = md5(f.read()).hexdigest()
+        if file_guid is None:
+            print(f"Failed to upload {image_path}")
+            return None
 
-                    file_mimetype = mimetypes.guess_type(image_path)[0]
-                    print(f"File mimetype: {file_mimetype}")
+        print(f"Uploaded {image_path} as {file_guid}")
 
-                    file_guid = upload_to_api(image_path, f, file_mimetype)
+        ## -- Add each defect associated with each unique image, all in one request
 
-                if file_guid is None:
-                    print(f"Failed to upload {image_path}")
-                    continue
+        labels = []
 
-                print(f"Uploaded {image_path} as {file_guid}")
-                image_cache.append(file_hash)
+        # one conversion to python floats instead of boxing every row as a Series
+        boxes = df[["xmin_n", "ymin_n", "xmax_n", "ymax_n"]].to_numpy().tolist()
 
-                upload_tag_to_api(file_guid, "RetinaNet-POC")
+        for label, (xmin, ymin, xmax, ymax) in zip(df["defect"], boxes):
+            # cycle through each defect
+            payload = [
+                {"x": xmin, "y": ymin},
+                {"x": xmax, "y": ymin},
+                {"x": xmax, "y": ymax},
+                {"x": xmin, "y": ymax},
+            ]
 
-                ## -- Add each defect associated with each unique image
+            print("payload: ", payload)
 
-                for index, row in df.iterrows():
-                    # cycle through each defect
-                    label = row["defect"]
-                    xmin = float(row["xmin_n"])
-                    xmax = float(row["xmax_n"])
-                    ymin = float(row["ymin_n"])
-                    ymax = float(row["ymax_n"])
+            labels.append({"label": label, "polygon": payload})
 
-                    payload = [
-                        {"x": xmin, "y": ymin},
-                        {"x": xmax, "y": ymin},
-                        {"x": xmax, "y": ymax},
-                        {"x": xmin, "y": ymax},
-                    ]
+        await send_labels_to_api(client, file_guid, labels)
 
-                    print("payload: ", payload)
+        # recorded as soon as it's done, so an interrupted run still saves it
+        uploaded.add(file_hash)
 
-                    send_label_to_api(file_guid, label, payload)
+        return df
 
-                # combine final dataframe
-                df_f = pd.concat([df_f, df], ignore_index=True)
-            else:
-                print(f"Skipping {filename}: No associated .xml file found.")
+
+async def upload_images(image_paths, uploaded):
+    """runs the upload for every (image, xml) pair, at most UPLOAD_CONCURRENCY at a time"""
+
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async with httpx.AsyncClient(
+        auth=(API_KEY, API_SECRET),
+        timeout=600.0,
+        limits=httpx.Limits(max_connections=64),
+    ) as client:
+        return await asyncio.gather(
+            *[
+                process_image(client, semaphore, uploaded, image_path, xml_path)
+                for image_path, xml_path in image_paths
+            ]
+        )
+
+
+def main():
+    uploaded = load_uploaded_hashes()
+
+    # combined_folder = r"C:\Users\endle\Desktop\object-detection-pytorch-wandb-coco\data\combined"
+    # combined_folder = r"C:\Users\Administrator\Desktop\defect-detection\TSI  -object-detection-pytorch-wandb-coco\data\combined"
+    combined_folder = r"C:\Users\sblac\Programming\tubes\object-detection-pytorch-wandb-coco\data\train2017"
+
+    # collect images and annotations in one pass over the folder and pair them by
+    # name, rather than checking for each image's .xml file on disk
+    bmp_paths = {}
+    xml_paths = {}
+
+    with os.scandir(combined_folder) as entries:
+        for entry in entries:
+            name = entry.name
+
+            if name.endswith(".bmp"):
+                bmp_paths[name[:-4]] = entry.path
+            elif name.endswith(".xml"):
+                xml_paths[name[:-4]] = entry.path
+
+    image_paths = []
+
+    for stem, bmp_path in bmp_paths.items():
+        xml_path = xml_paths.get(stem)
+
+        if xml_path is not None:
+            image_paths.append((bmp_path, xml_path))
+        else:
+            print(f"Skipping {stem}.bmp: No associated .xml file found.")
+
+    # save whatever finished even when the run crashes or is interrupted partway
+    try:
+        results = asyncio.run(upload_images(image_paths, uploaded))
+    finally:
+        save_uploaded_hashes(uploaded)
+
+    dfs = [df for df in results if df is not None]
+
+    # combine final dataframe once, concatenating per image is quadratic
+    if dfs:
+        df_f = pd.concat(dfs, ignore_index=True, copy=False)
+    else:
+        df_f = pd.DataFrame(
+            columns=[
+                "image_path",
+                "h",
+                "w",
+                "c",
+                "defect",
+                "xmin_n",
+                "ymin_n",
+                "xmax_n",
+                "ymax_n",
+            ]
+        )
 
     print("Defect plots generated successfully!")
-    df_f.to_csv("images-uploaded-to-s3.csv")
+    # the index is just a row counter after the concat, so leave it out of the file
+    df_f.to_csv("images-uploaded-to-s3.csv", index=False)
     print(df_f)
 
 